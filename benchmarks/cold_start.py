@@ -0,0 +1,108 @@
+"""Measures the cold start of union.py: how long the module takes to import and how long the first and second
+invocations take, for an EC2 instance event and for classic and v2 load balancer events.
+
+Each measurement runs in a new Python process so that nothing is cached, and every AWS call is answered by the
+in-process stand-ins, so no network access or credentials are needed.
+
+    python benchmarks/cold_start.py [--runs N]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+EVENT_TYPES = ['instance', 'lbv1', 'lbv2']
+
+
+def offline_environment():
+    environment = dict(os.environ)
+    environment.update({
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'standins',
+        'AWS_SECRET_ACCESS_KEY': 'standins',
+        'AWS_EC2_METADATA_DISABLED': 'true',
+        'DDNS_READY_TIMEOUT': '0'
+    })
+    environment.pop('AWS_PROFILE', None)
+    return environment
+
+
+def measure(event_type):
+    """Runs in the child process and prints the measurements as JSON."""
+    start = time.time()
+    import union
+    import_seconds = time.time() - start
+
+    import standins
+    aws = standins.StandIns()
+    aws.install(union.get_aws_session())
+    aws.add_vpc('vpc-1', domain_name='corp.example.com')
+    aws.add_subnet('subnet-1', 'vpc-1', '10.1.2.0/24')
+    aws.add_zone('corp.example.com', private=True, vpcs=['vpc-1'])
+    aws.add_zone('2.1.10.in-addr.arpa', private=True, vpcs=['vpc-1'])
+    tags = [('ZONE', 'corp.example.com.'), ('CNAME', 'app.corp.example.com')]
+    if event_type == 'instance':
+        first_event = standins.ec2_event(aws.add_instance('subnet-1', '10.1.2.10', tags=tags), 'running')
+        second_event = standins.ec2_event(aws.add_instance('subnet-1', '10.1.2.11', tags=tags), 'running')
+    elif event_type == 'lbv1':
+        first_event = standins.lbv1_event(aws, aws.add_load_balancer('lb-1', 'vpc-1', tags=tags), 'CreateLoadBalancer')
+        second_event = standins.lbv1_event(aws, aws.add_load_balancer('lb-2', 'vpc-1', tags=tags), 'CreateLoadBalancer')
+    else:
+        first_event = standins.lbv2_event(aws, aws.add_load_balancer_v2('lb-1', 'vpc-1', tags=tags), 'CreateLoadBalancer')
+        second_event = standins.lbv2_event(aws, aws.add_load_balancer_v2('lb-2', 'vpc-1', tags=tags), 'CreateLoadBalancer')
+
+    # Keep the function's own output out of the measurements
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        union.lambda_handler(first_event, standins.FakeContext())
+        first_seconds = time.time() - start
+        start = time.time()
+        union.lambda_handler(second_event, standins.FakeContext())
+        second_seconds = time.time() - start
+    finally:
+        sys.stdout = stdout
+
+    clients = filter(lambda x: isinstance(x, union.LazyClient), vars(union).values())
+    print json.dumps({
+        'event_type': event_type,
+        'import_seconds': import_seconds,
+        'first_invocation_seconds': first_seconds,
+        'second_invocation_seconds': second_seconds,
+        'clients_created': sorted(map(lambda x: x.service_name + (' resource' if x.resource else ''),
+                                      filter(lambda x: x.instance is not None, clients)))
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=3, help='number of cold starts to measure per event type')
+    parser.add_argument('--child', choices=EVENT_TYPES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        measure(args.child)
+        return
+
+    print '%-10s %12s %18s %19s  %s' % ('event', 'import (s)', 'first invoke (s)', 'second invoke (s)', 'clients created')
+    for event_type in EVENT_TYPES:
+        results = []
+        for _ in range(args.runs):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', event_type],
+                                             env=offline_environment())
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        average = lambda key: sum(map(lambda x: x[key], results)) / len(results)
+        print '%-10s %12.3f %18.3f %19.3f  %s' % (event_type, average('import_seconds'),
+                                                  average('first_invocation_seconds'),
+                                                  average('second_invocation_seconds'),
+                                                  ', '.join(results[-1]['clients_created']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""Reports what one event costs: the wall time, the AWS calls per service and the Route 53 changes of instance, classic
+load balancer and v2 load balancer create and destroy events, in accounts with N hosted zones and assets with M tags.
+
+Every scenario starts a new container by reloading union.py, so the first event it measures is a cold one; the second
+event, for another asset, is a warm one.  Destroy scenarios create their assets in an earlier container.  Every AWS
+call is answered by the in-process stand-ins, so no network access or credentials are needed.
+
+The number of calls of each event is compared with the recorded baseline, and the command fails if any of them went
+up.  Record a new baseline with --update-baseline after a change that is meant to make more calls.
+
+    python benchmarks/event_cost.py [--zones 10,300] [--tags 3,12] [--update-baseline]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+os.environ.update({
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'standins',
+    'AWS_SECRET_ACCESS_KEY': 'standins',
+    'AWS_EC2_METADATA_DISABLED': 'true',
+    'DDNS_READY_TIMEOUT': '0'
+})
+os.environ.pop('AWS_PROFILE', None)
+
+import standins
+import union
+
+ASSET_TYPES = ['instance', 'lbv1', 'lbv2']
+ACTIONS = ['create', 'destroy']
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'event_cost_baseline.json')
+
+
+def quietly(function, *args):
+    """Calls the function with its output suppressed."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def new_container(aws):
+    """Reloads union.py, as a new Lambda container would load it, and points its clients at the stand-ins."""
+    quietly(reload, union)
+    aws.install(union.get_aws_session())
+
+
+def add_asset(aws, asset_type, number, tag_count):
+    """Adds an asset and returns functions that build its create and destroy events."""
+    tags = aws.synthetic_tags(tag_count, number)
+    if asset_type == 'instance':
+        instance_id = aws.add_instance('subnet-1', '10.1.%d.%d' % (number // 200, number % 200 + 10),
+                                       public_ip='54.0.0.%d' % (number + 10), tags=tags)
+        return lambda: standins.ec2_event(instance_id, 'running'), lambda: standins.ec2_event(instance_id, 'terminated')
+    if asset_type == 'lbv1':
+        name = aws.add_load_balancer('lb-%d' % number, 'vpc-1', tags=tags)
+        return (lambda: standins.lbv1_event(aws, name, 'CreateLoadBalancer'),
+                lambda: standins.lbv1_event(aws, name, 'DeleteLoadBalancer'))
+    arn = aws.add_load_balancer_v2('lb-%d' % number, 'vpc-1', tags=tags)
+    return (lambda: standins.lbv2_event(aws, arn, 'CreateLoadBalancer'),
+            lambda: standins.lbv2_event(aws, arn, 'DeleteLoadBalancer'))
+
+
+def invoke(aws, event):
+    """Runs lambda_handler for the event with its output suppressed and returns what it cost."""
+    aws.calls.clear()
+    aws.record_changes = 0
+    start = time.time()
+    quietly(union.lambda_handler, event, standins.FakeContext())
+    seconds = time.time() - start
+    return {'seconds': seconds, 'calls': dict(aws.calls), 'record_changes': aws.record_changes}
+
+
+def run_scenario(asset_type, action, zone_count, tag_count):
+    """Returns the cost of a cold and a warm event of the scenario."""
+    aws = standins.StandIns()
+    new_container(aws)
+    aws.add_synthetic_fleet(zone_count)
+    assets = [add_asset(aws, asset_type, number, tag_count) for number in range(2)]
+    if action == 'destroy':
+        for create_event, _ in assets:
+            invoke(aws, create_event())
+        new_container(aws)
+    index = 0 if action == 'create' else 1
+    return {
+        'cold': invoke(aws, assets[0][index]()),
+        'warm': invoke(aws, assets[1][index]())
+    }
+
+
+def calls_by_service(calls):
+    services = Counter()
+    for operation, count in calls.items():
+        services[operation.split('.')[0]] += count
+    return ', '.join('%s %d' % x for x in sorted(services.items()))
+
+
+def compare(name, cost, baseline):
+    """Returns a description of every operation that is called more often than in the baseline."""
+    if baseline is None:
+        return []
+    increases = []
+    for operation, count in sorted(cost['calls'].items()):
+        if count > baseline['calls'].get(operation, 0):
+            increases.append('%s: %s called %d time(s), baseline %d' % (name, operation, count,
+                                                                         baseline['calls'].get(operation, 0)))
+    if sum(cost['calls'].values()) > sum(baseline['calls'].values()):
+        increases.append('%s: %d call(s) in total, baseline %d' % (name, sum(cost['calls'].values()),
+                                                                   sum(baseline['calls'].values())))
+    return increases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--zones', default='10,300', help='comma-separated numbers of hosted zones in the account')
+    parser.add_argument('--tags', default='3,12', help='comma-separated numbers of tags on each asset')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='JSON file with the recorded call counts')
+    parser.add_argument('--update-baseline', action='store_true', help='record the call counts as the new baseline')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    increases = []
+    print '%-17s %6s %5s %5s %9s %6s %8s  %s' % ('event', 'zones', 'tags', 'start', 'wall (s)', 'calls', 'changes',
+                                                'calls per service')
+    for asset_type in ASSET_TYPES:
+        for action in ACTIONS:
+            for zone_count in map(int, args.zones.split(',')):
+                for tag_count in map(int, args.tags.split(',')):
+                    scenario = run_scenario(asset_type, action, zone_count, tag_count)
+                    for start in ['cold', 'warm']:
+                        cost = scenario[start]
+                        name = '%s-%s zones=%d tags=%d %s' % (asset_type, action, zone_count, tag_count, start)
+                        results[name] = {'calls': cost['calls'], 'record_changes': cost['record_changes']}
+                        increases.extend(compare(name, cost, baseline.get(name)))
+                        print '%-17s %6d %5d %5s %9.3f %6d %8d  %s' % (
+                            asset_type + ' ' + action, zone_count, tag_count, start, cost['seconds'],
+                            sum(cost['calls'].values()), cost['record_changes'], calls_by_service(cost['calls']))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, separators=(',', ': '), sort_keys=True)
+            baseline_file.write('\n')
+        print '\nRecorded the baseline in %s' % args.baseline
+        return
+    if not baseline:
+        print '\nNo baseline recorded in %s yet; record one with --update-baseline' % args.baseline
+        return
+    if increases:
+        print '\nMore AWS calls than the baseline in %s:' % args.baseline
+        for increase in increases:
+            print '  ' + increase
+        sys.exit(1)
+    print '\nNo event makes more AWS calls than the baseline'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""Replays a JSONL file of recorded CloudWatch events, the EC2 state-change and ELB CreateLoadBalancer and
+DeleteLoadBalancer events that ddns.template routes to union.lambda_handler, against the in-process stand-ins at a set
+rate and concurrency, and reports the throughput, the handler latency, the throttled and retried calls and whether DNS
+ended up right.
+
+Each concurrent worker is a container of its own: a separate copy of union.py with its own globals and AWS clients,
+which takes the next event from a queue as Lambda would hand it to a warm container.  Before an event is queued, the
+stand-ins are brought to the state it announces: the instance is added or its state changed, and the load balancer is
+added or removed.  Instances get addresses in a synthetic fleet of hosted zones and tags like event_cost.py's.
+
+The stand-ins can add latency to every call, throttle calls at random and limit Route 53 writes to a rate, as Route 53
+does with five requests per second per account.  union.py retries throttled Route 53 writes itself, so each throttled
+ChangeResourceRecordSets call is counted as a retry; a throttled call of another operation fails its event, as one
+that outlasts botocore's own retries would.
+
+Once every event has been handled, union.reconcile_handler is run in a new container with dry_run set, and DNS is
+right if it finds no record to create or change and every A, PTR and CNAME record in the zones is one it wants.
+reconcile_handler only deletes records that the record index knows of, so records that are left over without an
+index item are counted as stale as well.
+
+    python benchmarks/replay.py events.jsonl [--rate 50] [--concurrency 10] [--latency 0.02] [--throttle 0.05]
+    python benchmarks/replay.py events.jsonl --generate 500
+"""
+import argparse
+import imp
+import json
+import os
+import Queue
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+UNION_PATH = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'union.py')
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+os.environ.update({
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'standins',
+    'AWS_SECRET_ACCESS_KEY': 'standins',
+    'AWS_EC2_METADATA_DISABLED': 'true',
+    'DDNS_READY_TIMEOUT': '0'
+})
+os.environ.pop('AWS_PROFILE', None)
+
+import standins
+
+EVENT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def generate_events(path, instance_count, load_balancer_count, duplicate_share, terminate_share):
+    """Writes a launch storm to path: instances that start running, classic and v2 load balancers that are created, a
+    share of repeated deliveries, and a minute later the termination of a share of the instances and the deletion of a
+    share of the load balancers."""
+    aws = standins.StandIns()
+    start = datetime(2020, 1, 1)
+    events = []
+    for number in range(instance_count):
+        instance_id = 'i-%017x' % (number + 1)
+        event_time = (start + timedelta(seconds=number // 50)).strftime(EVENT_TIME_FORMAT)
+        events.append(standins.ec2_event(instance_id, 'running', event_time=event_time))
+        if random.random() < terminate_share:
+            for state in ['shutting-down', 'terminated']:
+                event_time = (start + timedelta(seconds=60 + number // 50)).strftime(EVENT_TIME_FORMAT)
+                events.append(standins.ec2_event(instance_id, state, event_time=event_time))
+    for number in range(load_balancer_count):
+        event_time = (start + timedelta(seconds=number // 10)).strftime(EVENT_TIME_FORMAT)
+        delete_time = (start + timedelta(seconds=60 + number // 10)).strftime(EVENT_TIME_FORMAT)
+        if number % 2:
+            name = aws.add_load_balancer('replay-lb-%d' % number, 'vpc-1')
+            create_event = standins.lbv1_event(aws, name, 'CreateLoadBalancer', event_time)
+            delete_event = standins.lbv1_event(aws, name, 'DeleteLoadBalancer', delete_time)
+        else:
+            arn = aws.add_load_balancer_v2('replay-lb-%d' % number, 'vpc-1')
+            create_event = standins.lbv2_event(aws, arn, 'CreateLoadBalancer', event_time)
+            delete_event = standins.lbv2_event(aws, arn, 'DeleteLoadBalancer', delete_time)
+        events.append(create_event)
+        if random.random() < terminate_share:
+            events.append(delete_event)
+    events.extend(map(dict, random.sample(events, int(len(events) * duplicate_share))))
+    events.sort(key=lambda x: x['time'])
+    with open(path, 'w') as events_file:
+        for event in events:
+            events_file.write(json.dumps(event, sort_keys=True) + '\n')
+    print 'Wrote %d events to %s' % (len(events), path)
+
+
+def read_events(path):
+    with open(path) as events_file:
+        return map(json.loads, filter(None, map(lambda x: x.strip(), events_file)))
+
+
+class Fleet(object):
+    """Brings the stand-ins to the state that each event announces."""
+
+    def __init__(self, aws, tag_count):
+        self.aws = aws
+        self.tag_count = tag_count
+        self.asset_count = 0
+
+    def next_tags(self):
+        self.asset_count += 1
+        return self.aws.synthetic_tags(self.tag_count, self.asset_count)
+
+    def apply(self, event):
+        detail = event['detail']
+        if event['source'] == 'aws.ec2':
+            instance_id = detail['instance-id']
+            if instance_id not in self.aws.instances:
+                number = len(self.aws.instances)
+                self.aws.add_instance('subnet-1', '10.1.%d.%d' % (number // 250, number % 250 + 4),
+                                      tags=self.next_tags(), instance_id=instance_id)
+            self.aws.set_instance_state(instance_id, detail['state'])
+        elif detail['eventName'] == 'CreateLoadBalancer':
+            if detail.get('apiVersion') == '2015-12-01':
+                response = detail['responseElements']['loadBalancers'][0]
+                if response['loadBalancerArn'] not in self.aws.load_balancers_v2:
+                    self.aws.add_load_balancer_v2(response['loadBalancerName'], 'vpc-1', tags=self.next_tags(),
+                                                  arn=response['loadBalancerArn'])
+            elif detail['requestParameters']['loadBalancerName'] not in self.aws.load_balancers:
+                self.aws.add_load_balancer(detail['requestParameters']['loadBalancerName'], 'vpc-1',
+                                           tags=self.next_tags())
+        elif detail['eventName'] == 'DeleteLoadBalancer':
+            request_parameters = detail['requestParameters']
+            self.aws.remove_load_balancer(request_parameters.get('loadBalancerArn') or request_parameters.get('loadBalancerName'))
+
+
+def new_container(aws, number):
+    """Loads a copy of union.py, as a new Lambda container would load it, and points its clients at the stand-ins."""
+    container = imp.load_source('union_container_%d' % number, UNION_PATH)
+    aws.install(container.get_aws_session())
+    return container
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(share * (len(values) - 1)))]
+
+
+def calls_by_service(calls):
+    services = Counter()
+    for operation, count in calls.items():
+        services[operation.split('.')[0]] += count
+    return ', '.join('%s %d' % x for x in sorted(services.items()))
+
+
+def replay(events, fleet, containers, rate, timeout):
+    """Queues the events at the rate, zero meaning all at once, and has one worker per container handle them.
+    Returns the handler latency and the time from queueing to handled of each event, and the events that failed."""
+    fleet_queue = Queue.Queue()
+    results = []
+    failures = []
+    lock = threading.Lock()
+
+    def work(container):
+        while True:
+            item = fleet_queue.get()
+            if item is None:
+                return
+            event, queued_at = item
+            start = time.time()
+            try:
+                container.lambda_handler(event, standins.FakeContext(timeout))
+            except BaseException as e:
+                with lock:
+                    failures.append((event, e))
+            finished_at = time.time()
+            with lock:
+                results.append((finished_at - start, finished_at - queued_at))
+
+    workers = map(lambda x: threading.Thread(target=work, args=(x,)), containers)
+    for worker in workers:
+        worker.start()
+    start = time.time()
+    for index, event in enumerate(events):
+        if rate:
+            time.sleep(max(0, start + float(index) / rate - time.time()))
+        fleet.apply(event)
+        fleet_queue.put((event, time.time()))
+    for _ in workers:
+        fleet_queue.put(None)
+    for worker in workers:
+        worker.join()
+    return time.time() - start, results, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('events', help='JSONL file with one recorded CloudWatch event per line')
+    parser.add_argument('--generate', type=int, metavar='N',
+                        help='write a launch storm of N instances to the events file instead of replaying it')
+    parser.add_argument('--load-balancers', type=int, default=0,
+                        help='number of load balancers in a generated launch storm')
+    parser.add_argument('--duplicates', type=float, default=0.1,
+                        help='share of generated events that are delivered twice')
+    parser.add_argument('--terminate', type=float, default=0.3,
+                        help='share of generated instances and load balancers that are removed again')
+    parser.add_argument('--rate', type=float, default=50, help='events queued per second, 0 for all at once')
+    parser.add_argument('--concurrency', type=int, default=10, help='number of concurrent containers')
+    parser.add_argument('--timeout', type=float, default=90, help='seconds each invocation may take')
+    parser.add_argument('--zones', type=int, default=10, help='number of hosted zones in the account')
+    parser.add_argument('--tags', type=int, default=3, help='number of tags on each asset')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every AWS call')
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='probability that a call of a --throttle-operations operation is throttled')
+    parser.add_argument('--throttle-operations', default='route53.ChangeResourceRecordSets',
+                        help='comma-separated operations that --throttle applies to, or * for all')
+    parser.add_argument('--route53-rate', type=float, default=5,
+                        help='Route 53 write requests per second before they are throttled, 0 for no limit')
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_events(args.events, args.generate, args.load_balancers, args.duplicates, args.terminate)
+        return
+
+    events = read_events(args.events)
+    aws = standins.StandIns()
+    aws.add_synthetic_fleet(args.zones)
+    if args.latency:
+        aws.latency['*'] = args.latency
+    for operation in args.throttle_operations.split(','):
+        aws.throttling[operation] = args.throttle
+    if args.route53_rate:
+        aws.rate_limits['route53.ChangeResourceRecordSets'] = args.route53_rate
+
+    # Keep the function's own output out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        containers = map(lambda x: new_container(aws, x), range(args.concurrency))
+        # Create the DDNS table up front, as the stack would have by the time of a launch storm
+        containers[0].get_table('DDNS')
+        aws.calls.clear()
+        aws.throttled.clear()
+        seconds, results, failures = replay(events, Fleet(aws, args.tags), containers, args.rate, args.timeout)
+        calls = Counter(aws.calls)
+        throttled = Counter(aws.throttled)
+        # Check the records with the same rules the function creates them with, without changing them
+        aws.throttling.clear()
+        aws.rate_limits.clear()
+        aws.latency.clear()
+        check = new_container(aws, args.concurrency).reconcile_handler(
+            {'dry_run': True, 'zone_ids': aws.zones.keys()}, standins.FakeContext(900))
+        zone_records = sum(len(filter(lambda x: x[1] in ('A', 'PTR', 'CNAME'), aws.records(x))) for x in aws.zones)
+        stale = zone_records - check['unchanged']
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    handler_latencies = map(lambda x: x[0], results)
+    queue_latencies = map(lambda x: x[1], results)
+    print 'events             %d in %.2fs, %.1f per second, %d failed' % (len(events), seconds,
+                                                                            len(events) / seconds, len(failures))
+    print 'handler latency    p50 %.3fs  p99 %.3fs  max %.3fs' % (percentile(handler_latencies, 0.5),
+                                                                  percentile(handler_latencies, 0.99),
+                                                                  max(handler_latencies or [0]))
+    print 'queued to handled  p50 %.3fs  p99 %.3fs' % (percentile(queue_latencies, 0.5),
+                                                      percentile(queue_latencies, 0.99))
+    print 'AWS calls          %d (%s)' % (sum(calls.values()), calls_by_service(calls))
+    print 'throttled calls    %d (%s)' % (sum(throttled.values()), ', '.join('%s %d' % x for x in sorted(throttled.items())) or 'none')
+    print 'retries            %d' % throttled['route53.ChangeResourceRecordSets']
+    print 'DNS correct        %s (%d records right, %d missing or wrong, %d stale)' % (
+        'yes' if not check['upserts'] and not stale else 'NO', check['unchanged'], check['upserts'], stale)
+    for event, error in failures[:10]:
+        print '  failed %s %s: %r' % (event['source'], event['detail'].get('instance-id') or event['detail'].get('eventName'), error)
+    if failures or check['upserts'] or stale:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
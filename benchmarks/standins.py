@@ -0,0 +1,850 @@
+"""In-process stand-ins for the AWS APIs that union.py calls.
+
+The stand-ins answer the botocore 'before-call' event of every client created from a session, the same hook that
+botocore's Stubber uses, so requests never leave the process while the real clients, service models and parameter
+validation are still exercised.  Unknown operations raise NotImplementedError rather than reaching the network.
+"""
+import copy
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from decimal import Decimal
+
+from botocore import xform_name
+from botocore.awsrequest import AWSResponse
+
+ACCOUNT_ID = '123456789012'
+
+# The error code each service answers a throttled call with
+THROTTLING_ERRORS = {
+    'route53': 'Throttling',
+    'ec2': 'RequestLimitExceeded',
+    'elb': 'Throttling',
+    'elbv2': 'Throttling',
+    'dynamodb': 'ProvisionedThroughputExceededException'
+}
+
+
+def zone_sort_key(name):
+    """Route 53 lists zones and records by their labels in reverse order, e.g. com.example.www."""
+    return list(reversed(name.lower().rstrip('.').split('.')))
+
+
+def normalize_name(name):
+    name = name.lower()
+    if not name.endswith('.'):
+        name = name + '.'
+    return name
+
+
+class ServiceError(Exception):
+    """Raised by a stand-in operation to make the client raise a ClientError."""
+    def __init__(self, code, message='', status_code=400):
+        Exception.__init__(self, code)
+        self.code = code
+        self.message = message or code
+        self.status_code = status_code
+
+
+class StandIns(object):
+    """Holds the state of the stand-in Route 53, EC2, ELB, ELBv2 and DynamoDB services of one account and region.
+    Calls made with the credentials of an assumed role, or in another region, are answered from the same state."""
+
+    def __init__(self, region='us-east-1'):
+        self.region = region
+        self.lock = threading.RLock()
+        self.zones = {}
+        self.instances = {}
+        self.vpcs = {}
+        self.subnets = {}
+        self.dhcp_options = {}
+        self.load_balancers = {}
+        self.load_balancers_v2 = {}
+        self.tables = {}
+        self.calls = Counter()
+        self.record_changes = 0
+        self.next_id = 0
+        # Injected faults, keyed by operation, e.g. 'route53.ChangeResourceRecordSets', or '*' for every operation:
+        # seconds of latency, the probability that a call is throttled and a rate limit in calls per second
+        self.latency = {}
+        self.throttling = {}
+        self.rate_limits = {}
+        self.rate_buckets = {}
+        self.throttled = Counter()
+        # The role ARNs assumed through STS, in order, and how many seconds their credentials last
+        self.assumed_roles = []
+        self.credential_seconds = 3600
+
+    # Setting up the account
+
+    def new_id(self, prefix, length=17):
+        with self.lock:
+            self.next_id += 1
+            return prefix + ('%x' % self.next_id).zfill(length)
+
+    def add_zone(self, name, private=False, vpcs=()):
+        """Adds a hosted zone with its SOA and NS records and returns its id.  vpcs is a list of VPC ids in the
+        stand-in region or of (region, VPC id) pairs."""
+        zone_id = self.new_id('Z', 13).upper()
+        name = normalize_name(name)
+        self.zones[zone_id] = {
+            'Id': '/hostedzone/' + zone_id,
+            'Name': name,
+            'CallerReference': zone_id,
+            'Config': {'PrivateZone': private},
+            'vpcs': set(map(lambda x: x if isinstance(x, tuple) else (self.region, x), vpcs)),
+            'records': {
+                (name, 'SOA'): {'Name': name, 'Type': 'SOA', 'TTL': 900, 'ResourceRecords': [
+                    {'Value': 'ns-1.awsdns-00.com. awsdns-hostmaster.amazon.com. 1 7200 900 1209600 86400'}]},
+                (name, 'NS'): {'Name': name, 'Type': 'NS', 'TTL': 172800, 'ResourceRecords': [
+                    {'Value': 'ns-1.awsdns-00.com.'}]}
+            }
+        }
+        return zone_id
+
+    def add_vpc(self, vpc_id, domain_name=None, dns_hostnames=True, dns_support=True):
+        dhcp_options_id = 'default'
+        if domain_name is not None:
+            dhcp_options_id = self.new_id('dopt-')
+            self.dhcp_options[dhcp_options_id] = [
+                {'Key': 'domain-name', 'Values': [{'Value': domain_name}]},
+                {'Key': 'domain-name-servers', 'Values': [{'Value': 'AmazonProvidedDNS'}]}
+            ]
+        self.vpcs[vpc_id] = {
+            'VpcId': vpc_id,
+            'State': 'available',
+            'CidrBlock': '10.0.0.0/8',
+            'DhcpOptionsId': dhcp_options_id,
+            'dns_hostnames': dns_hostnames,
+            'dns_support': dns_support
+        }
+        return vpc_id
+
+    def add_subnet(self, subnet_id, vpc_id, cidr_block, ipv6_cidr_block=None):
+        self.subnets[subnet_id] = {'SubnetId': subnet_id, 'VpcId': vpc_id, 'CidrBlock': cidr_block, 'State': 'available',
+                                   'Ipv6CidrBlockAssociationSet': []}
+        if ipv6_cidr_block:
+            self.subnets[subnet_id]['Ipv6CidrBlockAssociationSet'].append({
+                'AssociationId': self.new_id('subnet-cidr-assoc-'), 'Ipv6CidrBlock': ipv6_cidr_block,
+                'Ipv6CidrBlockState': {'State': 'associated'}})
+        return subnet_id
+
+    def add_instance(self, subnet_id, private_ip, public_ip=None, tags=(), instance_id=None, ipv6_address=None):
+        """Adds a running instance with the nested attributes of a real describe_instances response."""
+        instance_id = instance_id or self.new_id('i-')
+        subnet = self.subnets[subnet_id]
+        private_dns_name = 'ip-%s.ec2.internal' % private_ip.replace('.', '-')
+        public_dns_name = ''
+        if public_ip and self.vpcs[subnet['VpcId']]['dns_hostnames']:
+            public_dns_name = 'ec2-%s.compute-1.amazonaws.com' % public_ip.replace('.', '-')
+        network_interface = {
+            'NetworkInterfaceId': self.new_id('eni-'),
+            'SubnetId': subnet_id,
+            'VpcId': subnet['VpcId'],
+            'Status': 'in-use',
+            'PrivateIpAddress': private_ip,
+            'PrivateDnsName': private_dns_name,
+            'PrivateIpAddresses': [{'Primary': True, 'PrivateIpAddress': private_ip, 'PrivateDnsName': private_dns_name}],
+            'Groups': [{'GroupId': 'sg-0123456789abcdef0', 'GroupName': 'default'}],
+            'Attachment': {'AttachmentId': self.new_id('eni-attach-'), 'DeviceIndex': 0, 'Status': 'attached',
+                           'AttachTime': datetime(2020, 1, 1), 'DeleteOnTermination': True},
+            'Ipv6Addresses': [{'Ipv6Address': ipv6_address}] if ipv6_address else [],
+            'SourceDestCheck': True
+        }
+        instance = {
+            'InstanceId': instance_id,
+            'ImageId': 'ami-0123456789abcdef0',
+            'InstanceType': 't3.micro',
+            'State': {'Code': 16, 'Name': 'running'},
+            'LaunchTime': datetime(2020, 1, 1),
+            'Placement': {'AvailabilityZone': self.region + 'a', 'Tenancy': 'default'},
+            'PrivateIpAddress': private_ip,
+            'PrivateDnsName': private_dns_name,
+            'PublicDnsName': public_dns_name,
+            'SubnetId': subnet_id,
+            'VpcId': subnet['VpcId'],
+            'Architecture': 'x86_64',
+            'RootDeviceName': '/dev/xvda',
+            'BlockDeviceMappings': [{'DeviceName': '/dev/xvda', 'Ebs': {
+                'VolumeId': self.new_id('vol-'), 'Status': 'attached', 'AttachTime': datetime(2020, 1, 1),
+                'DeleteOnTermination': True}}],
+            'SecurityGroups': [{'GroupId': 'sg-0123456789abcdef0', 'GroupName': 'default'}],
+            'NetworkInterfaces': [network_interface],
+            'EbsOptimized': False,
+            'Tags': [{'Key': key, 'Value': value} for key, value in tags]
+        }
+        if public_ip:
+            instance['PublicIpAddress'] = public_ip
+            network_interface['Association'] = {'PublicIp': public_ip, 'PublicDnsName': public_dns_name,
+                                                'IpOwnerId': 'amazon'}
+        self.instances[instance_id] = instance
+        return instance_id
+
+    def add_load_balancer(self, name, vpc_id, scheme='internal', tags=()):
+        """Adds a classic load balancer and returns its name."""
+        self.load_balancers[name] = {
+            'description': {
+                'LoadBalancerName': name,
+                'DNSName': '%s%s-123456789.%s.elb.amazonaws.com' % ('internal-' if scheme == 'internal' else '', name, self.region),
+                'Scheme': scheme,
+                'VPCId': vpc_id,
+                'CreatedTime': datetime(2020, 1, 1),
+                'ListenerDescriptions': [{'Listener': {'Protocol': 'HTTP', 'LoadBalancerPort': 80,
+                                                       'InstanceProtocol': 'HTTP', 'InstancePort': 80}}],
+                'AvailabilityZones': [self.region + 'a'],
+                'Subnets': [],
+                'Instances': []
+            },
+            'tags': [{'Key': key, 'Value': value} for key, value in tags]
+        }
+        return name
+
+    def add_load_balancer_v2(self, name, vpc_id, scheme='internal', tags=(), lb_type='application', arn=None):
+        """Adds an application or network load balancer and returns its ARN."""
+        arn = arn or 'arn:aws:elasticloadbalancing:%s:%s:loadbalancer/%s/%s/%s' % (
+            self.region, ACCOUNT_ID, 'app' if lb_type == 'application' else 'net', name, self.new_id('', 16))
+        self.load_balancers_v2[arn] = {
+            'description': {
+                'LoadBalancerArn': arn,
+                'LoadBalancerName': name,
+                'DNSName': '%s%s-123456789.%s.elb.amazonaws.com' % ('internal-' if scheme == 'internal' else '', name, self.region),
+                'Scheme': scheme,
+                'VpcId': vpc_id,
+                'Type': lb_type,
+                'State': {'Code': 'active'},
+                'CreatedTime': datetime(2020, 1, 1),
+                'AvailabilityZones': [{'ZoneName': self.region + 'a', 'SubnetId': 'subnet-1'}],
+                'IpAddressType': 'ipv4'
+            },
+            'tags': [{'Key': key, 'Value': value} for key, value in tags]
+        }
+        return arn
+
+    def set_instance_state(self, instance_id, state):
+        with self.lock:
+            self.instances[instance_id]['State'] = {'Code': {'running': 16, 'shutting-down': 32, 'terminated': 48,
+                                                             'stopping': 64, 'stopped': 80}.get(state, 0),
+                                                    'Name': state}
+
+    def remove_load_balancer(self, load_balancer_id):
+        """Removes the classic load balancer with the name or the v2 load balancer with the ARN."""
+        with self.lock:
+            self.load_balancers.pop(load_balancer_id, None)
+            self.load_balancers_v2.pop(load_balancer_id, None)
+
+    def add_synthetic_fleet(self, zone_count):
+        """Adds a VPC whose DHCP option set names corp.example.com, a /16 subnet, the corp.example.com and reverse
+        lookup zones and zone_count - 2 more zones, alternately private to the VPC and public."""
+        self.add_vpc('vpc-1', domain_name='corp.example.com')
+        self.add_subnet('subnet-1', 'vpc-1', '10.1.0.0/16')
+        self.add_zone('corp.example.com', private=True, vpcs=['vpc-1'])
+        self.add_zone('1.10.in-addr.arpa', private=True, vpcs=['vpc-1'])
+        self.fleet_zones = {'private': ['corp.example.com.'], 'public': []}
+        for i in range(max(0, zone_count - 2)):
+            if i % 2 == 0:
+                self.fleet_zones['private'].append(normalize_name('private%d.example.com' % i))
+                self.add_zone('private%d.example.com' % i, private=True, vpcs=['vpc-1'])
+            else:
+                self.fleet_zones['public'].append(normalize_name('public%d.example.net' % i))
+                self.add_zone('public%d.example.net' % i)
+
+    def synthetic_tags(self, tag_count, asset_number):
+        """Returns tag_count tags for an asset of the synthetic fleet: a ZONE tag for corp.example.com followed by
+        CNAME tags in the private zones, CNAME tags in the public zones and tags the function ignores, in turn.  The
+        CNAMEs of different asset numbers don't collide."""
+        private_zones = self.fleet_zones['private']
+        public_zones = self.fleet_zones['public']
+        tags = [('ZONE', 'corp.example.com.')]
+        for i in range(1, tag_count):
+            if i % 3 == 1:
+                tags.append(('CNAME%d' % i, 'host%d-%d.%s' % (asset_number, i, private_zones[i % len(private_zones)])))
+            elif i % 3 == 2 and public_zones:
+                tags.append(('CNAME%d' % i, 'host%d-%d.%s' % (asset_number, i, public_zones[i % len(public_zones)])))
+            else:
+                tags.append(('Team%d' % i, 'platform'))
+        return tags
+
+    def records(self, zone_id):
+        """Returns the records of a zone as a dict of (name, type) to a sorted list of values."""
+        return dict((key, sorted(map(lambda x: x['Value'], record_set['ResourceRecords'])))
+                    for key, record_set in self.zones[zone_id]['records'].items())
+
+    # Hooking into botocore
+
+    def install(self, session):
+        """Answers every call made by clients created from the boto3 session from now on."""
+        session.events.register_last('before-parameter-build', self.capture_params, unique_id='standins-params')
+        session.events.register('before-call', self.answer, unique_id='standins-answer')
+
+    def capture_params(self, params, model, context, **kwargs):
+        # The parameters are captured after boto3 has applied its own transformations, e.g. the DynamoDB types
+        context['standins_params'] = copy.deepcopy(params)
+
+    def answer(self, model, context, **kwargs):
+        service_name = model.service_model.service_name
+        key = '%s.%s' % (service_name, model.name)
+        with self.lock:
+            self.calls[key] += 1
+        handler = getattr(self, '%s_%s' % (service_name.replace('-', '_'), xform_name(model.name)), None)
+        if handler is None:
+            raise NotImplementedError('The stand-ins do not implement %s' % key)
+        latency = self.latency.get(key, self.latency.get('*', 0))
+        if latency:
+            time.sleep(latency)
+        try:
+            if self.is_throttled(key):
+                raise ServiceError(THROTTLING_ERRORS.get(service_name, 'Throttling'), 'Rate exceeded')
+            with self.lock:
+                parsed = handler(**context.get('standins_params', {}))
+            status_code = 200
+        except ServiceError as e:
+            parsed = {'Error': {'Code': e.code, 'Message': e.message}}
+            status_code = e.status_code
+        parsed = copy.deepcopy(parsed)
+        parsed.setdefault('ResponseMetadata', {})
+        parsed['ResponseMetadata'].update({'RequestId': self.new_id('req-'), 'HTTPStatusCode': status_code,
+                                           'HTTPHeaders': {}, 'RetryAttempts': 0})
+        return AWSResponse('https://standins.invalid/', status_code, {}, None), parsed
+
+    def is_throttled(self, key):
+        """Returns True if the call is to be throttled, at random or because it exceeds the operation's rate limit."""
+        with self.lock:
+            throttled = random.random() < self.throttling.get(key, self.throttling.get('*', 0))
+            rate = self.rate_limits.get(key, self.rate_limits.get('*'))
+            if rate and not throttled:
+                bucket = self.rate_buckets.setdefault(key, {'tokens': rate, 'updated_at': time.time()})
+                now = time.time()
+                bucket['tokens'] = min(rate, bucket['tokens'] + (now - bucket['updated_at']) * rate)
+                bucket['updated_at'] = now
+                throttled = bucket['tokens'] < 1
+                if not throttled:
+                    bucket['tokens'] -= 1
+            if throttled:
+                self.throttled[key] += 1
+            return throttled
+
+    # Route 53
+
+    def zone_summary(self, zone):
+        summary = dict((key, value) for key, value in zone.items() if key not in ('vpcs', 'records'))
+        summary['ResourceRecordSetCount'] = len(zone['records'])
+        return summary
+
+    def get_zone(self, zone_id):
+        zone = self.zones.get(zone_id.split('/')[-1])
+        if zone is None:
+            raise ServiceError('NoSuchHostedZone', 'No hosted zone found with ID: %s' % zone_id, 404)
+        return zone
+
+    def route53_list_hosted_zones(self, Marker=None, MaxItems='100', **kwargs):
+        zones = sorted(self.zones.values(), key=lambda x: x['Id'])
+        if Marker:
+            zones = filter(lambda x: x['Id'].split('/')[-1] >= Marker, zones)
+        page = zones[:int(MaxItems)]
+        response = {'HostedZones': map(self.zone_summary, page), 'IsTruncated': len(zones) > len(page),
+                    'MaxItems': str(MaxItems), 'Marker': Marker or ''}
+        if response['IsTruncated']:
+            response['NextMarker'] = zones[len(page)]['Id'].split('/')[-1]
+        return response
+
+    def route53_list_hosted_zones_by_name(self, DNSName=None, HostedZoneId=None, MaxItems='100', **kwargs):
+        zones = sorted(self.zones.values(), key=lambda x: (zone_sort_key(x['Name']), x['Id']))
+        if DNSName:
+            start = (zone_sort_key(DNSName), '/hostedzone/' + HostedZoneId if HostedZoneId else '')
+            zones = filter(lambda x: (zone_sort_key(x['Name']), x['Id']) >= start, zones)
+        page = zones[:int(MaxItems)]
+        response = {'HostedZones': map(self.zone_summary, page), 'IsTruncated': len(zones) > len(page),
+                    'MaxItems': str(MaxItems)}
+        if DNSName:
+            response['DNSName'] = DNSName
+        if response['IsTruncated']:
+            response['NextDNSName'] = zones[len(page)]['Name']
+            response['NextHostedZoneId'] = zones[len(page)]['Id'].split('/')[-1]
+        return response
+
+    def route53_list_hosted_zones_by_vpc(self, VPCId, VPCRegion, MaxItems='100', NextToken=None):
+        zones = sorted(filter(lambda x: (VPCRegion, VPCId) in x['vpcs'], self.zones.values()), key=lambda x: x['Id'])
+        start = int(NextToken or 0)
+        page = zones[start:start + int(MaxItems)]
+        response = {
+            'HostedZoneSummaries': map(lambda x: {'HostedZoneId': x['Id'].split('/')[-1], 'Name': x['Name'],
+                                                  'Owner': {'OwningAccount': ACCOUNT_ID}}, page),
+            'MaxItems': str(MaxItems)
+        }
+        if start + len(page) < len(zones):
+            response['NextToken'] = str(start + len(page))
+        return response
+
+    def route53_get_hosted_zone(self, Id):
+        zone = self.get_zone(Id)
+        response = {'HostedZone': self.zone_summary(zone)}
+        if zone['Config']['PrivateZone']:
+            response['VPCs'] = map(lambda x: {'VPCRegion': x[0], 'VPCId': x[1]}, sorted(zone['vpcs']))
+        else:
+            response['DelegationSet'] = {'NameServers': ['ns-1.awsdns-00.com']}
+        return response
+
+    def change_info(self):
+        return {'ChangeInfo': {'Id': '/change/' + self.new_id('C', 13).upper(), 'Status': 'PENDING',
+                               'SubmittedAt': datetime.utcnow()}}
+
+    def route53_associate_vpc_with_hosted_zone(self, HostedZoneId, VPC, Comment=None):
+        zone = self.get_zone(HostedZoneId)
+        if not zone['Config']['PrivateZone']:
+            raise ServiceError('PublicZoneVPCAssociation', 'Public hosted zones cannot be associated with a VPC')
+        key = (VPC['VPCRegion'], VPC['VPCId'])
+        if key in zone['vpcs']:
+            raise ServiceError('ConflictingDomainExists', 'The VPC is already associated with the hosted zone')
+        zone['vpcs'].add(key)
+        return self.change_info()
+
+    def route53_create_hosted_zone(self, Name, CallerReference, VPC=None, HostedZoneConfig=None, **kwargs):
+        zone_id = self.add_zone(Name, private=VPC is not None, vpcs=[(VPC['VPCRegion'], VPC['VPCId'])] if VPC else [])
+        response = self.change_info()
+        response.update({'HostedZone': self.zone_summary(self.zones[zone_id]),
+                         'Location': 'https://route53.amazonaws.com/2013-04-01/hostedzone/' + zone_id})
+        if VPC:
+            response['VPC'] = VPC
+        return response
+
+    def route53_change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        zone = self.get_zone(HostedZoneId)
+        records = dict(zone['records'])
+        errors = []
+        for change in ChangeBatch['Changes']:
+            record_set = change['ResourceRecordSet']
+            key = (normalize_name(record_set['Name']), record_set['Type'])
+            if change['Action'] == 'CREATE' and key in records:
+                errors.append('Tried to create resource record set [name=\'%s\', type=\'%s\'] but it already exists' % key)
+            elif change['Action'] == 'DELETE':
+                if key not in records:
+                    errors.append('Tried to delete resource record set [name=\'%s\', type=\'%s\'] but it was not found' % key)
+                elif sorted(map(lambda x: x['Value'], records[key]['ResourceRecords'])) != sorted(map(lambda x: x['Value'], record_set['ResourceRecords'])):
+                    errors.append('Tried to delete resource record set [name=\'%s\', type=\'%s\'] but the values provided do not match the current values' % key)
+                else:
+                    del records[key]
+            else:
+                stored = dict(record_set)
+                stored['Name'] = key[0]
+                records[key] = stored
+        if errors:
+            raise ServiceError('InvalidChangeBatch', '[%s]' % ', '.join(errors))
+        zone['records'] = records
+        self.record_changes += len(ChangeBatch['Changes'])
+        return self.change_info()
+
+    def route53_list_resource_record_sets(self, HostedZoneId, StartRecordName=None, StartRecordType=None,
+                                          MaxItems='300', **kwargs):
+        zone = self.get_zone(HostedZoneId)
+        record_sets = sorted(zone['records'].values(), key=lambda x: (zone_sort_key(x['Name']), x['Type']))
+        if StartRecordName:
+            start = (zone_sort_key(StartRecordName), StartRecordType or '')
+            record_sets = filter(lambda x: (zone_sort_key(x['Name']), x['Type']) >= start, record_sets)
+        page = record_sets[:int(MaxItems)]
+        response = {'ResourceRecordSets': page, 'IsTruncated': len(record_sets) > len(page), 'MaxItems': str(MaxItems)}
+        if response['IsTruncated']:
+            response['NextRecordName'] = record_sets[len(page)]['Name']
+            response['NextRecordType'] = record_sets[len(page)]['Type']
+        return response
+
+    # EC2
+
+    def paginate(self, items, MaxResults=None, NextToken=None):
+        start = int(NextToken or 0)
+        end = start + int(MaxResults) if MaxResults else len(items)
+        return items[start:end], (str(end) if end < len(items) else None)
+
+    def ec2_describe_instances(self, InstanceIds=None, Filters=None, MaxResults=None, NextToken=None, **kwargs):
+        if InstanceIds:
+            missing = filter(lambda x: x not in self.instances, InstanceIds)
+            if missing:
+                raise ServiceError('InvalidInstanceID.NotFound', "The instance IDs '%s' do not exist" % ', '.join(missing))
+            instances = map(lambda x: self.instances[x], InstanceIds)
+        else:
+            instances = sorted(self.instances.values(), key=lambda x: x['InstanceId'])
+        for name, values in map(lambda x: (x['Name'], x['Values']), Filters or []):
+            if name == 'instance-state-name':
+                instances = filter(lambda x: x['State']['Name'] in values, instances)
+            elif name == 'vpc-id':
+                instances = filter(lambda x: x['VpcId'] in values, instances)
+        page, next_token = self.paginate(instances, MaxResults, NextToken)
+        response = {'Reservations': map(lambda x: {'ReservationId': 'r-' + x['InstanceId'][2:], 'OwnerId': ACCOUNT_ID,
+                                                   'Groups': [], 'Instances': [x]}, page)}
+        if next_token:
+            response['NextToken'] = next_token
+        return response
+
+    def get_vpc(self, vpc_id):
+        if vpc_id not in self.vpcs:
+            raise ServiceError('InvalidVpcID.NotFound', "The vpc ID '%s' does not exist" % vpc_id)
+        return self.vpcs[vpc_id]
+
+    def ec2_describe_vpc_attribute(self, VpcId, Attribute, DryRun=False):
+        vpc = self.get_vpc(VpcId)
+        if Attribute == 'enableDnsHostnames':
+            return {'VpcId': VpcId, 'EnableDnsHostnames': {'Value': vpc['dns_hostnames']}}
+        return {'VpcId': VpcId, 'EnableDnsSupport': {'Value': vpc['dns_support']}}
+
+    def ec2_describe_vpcs(self, VpcIds=None, **kwargs):
+        vpcs = map(self.get_vpc, VpcIds) if VpcIds else self.vpcs.values()
+        return {'Vpcs': map(lambda x: dict((k, v) for k, v in x.items() if not k.startswith('dns_')), vpcs)}
+
+    def ec2_describe_dhcp_options(self, DhcpOptionsIds=None, **kwargs):
+        for dhcp_options_id in DhcpOptionsIds or []:
+            if dhcp_options_id not in self.dhcp_options:
+                raise ServiceError('InvalidDhcpOptionID.NotFound', "The dhcpOption ID '%s' does not exist" % dhcp_options_id)
+        return {'DhcpOptions': map(lambda x: {'DhcpOptionsId': x, 'DhcpConfigurations': self.dhcp_options[x]},
+                                   DhcpOptionsIds or self.dhcp_options.keys())}
+
+    def ec2_describe_subnets(self, SubnetIds=None, **kwargs):
+        for subnet_id in SubnetIds or []:
+            if subnet_id not in self.subnets:
+                raise ServiceError('InvalidSubnetID.NotFound', "The subnet ID '%s' does not exist" % subnet_id)
+        return {'Subnets': map(lambda x: self.subnets[x], SubnetIds or self.subnets.keys())}
+
+    # Classic ELB
+
+    def elb_describe_load_balancers(self, LoadBalancerNames=None, Marker=None, PageSize=None):
+        if LoadBalancerNames:
+            missing = filter(lambda x: x not in self.load_balancers, LoadBalancerNames)
+            if missing:
+                raise ServiceError('LoadBalancerNotFound', 'There is no ACTIVE Load Balancer named \'%s\'' % missing[0])
+            names = LoadBalancerNames
+        else:
+            names = sorted(self.load_balancers)
+        page, next_marker = self.paginate(names, PageSize, Marker)
+        response = {'LoadBalancerDescriptions': map(lambda x: self.load_balancers[x]['description'], page)}
+        if next_marker:
+            response['NextMarker'] = next_marker
+        return response
+
+    def elb_describe_tags(self, LoadBalancerNames):
+        missing = filter(lambda x: x not in self.load_balancers, LoadBalancerNames)
+        if missing:
+            raise ServiceError('LoadBalancerNotFound', 'There is no ACTIVE Load Balancer named \'%s\'' % missing[0])
+        return {'TagDescriptions': map(lambda x: {'LoadBalancerName': x, 'Tags': self.load_balancers[x]['tags']},
+                                       LoadBalancerNames)}
+
+    # ELBv2
+
+    def elbv2_describe_load_balancers(self, LoadBalancerArns=None, Names=None, Marker=None, PageSize=None):
+        if LoadBalancerArns:
+            missing = filter(lambda x: x not in self.load_balancers_v2, LoadBalancerArns)
+            if missing:
+                raise ServiceError('LoadBalancerNotFound', 'One or more load balancers not found')
+            arns = LoadBalancerArns
+        elif Names:
+            arns = filter(lambda x: self.load_balancers_v2[x]['description']['LoadBalancerName'] in Names,
+                          self.load_balancers_v2)
+            if len(arns) < len(Names):
+                raise ServiceError('LoadBalancerNotFound', 'One or more load balancers not found')
+        else:
+            arns = sorted(self.load_balancers_v2)
+        page, next_marker = self.paginate(arns, PageSize, Marker)
+        response = {'LoadBalancers': map(lambda x: self.load_balancers_v2[x]['description'], page)}
+        if next_marker:
+            response['NextMarker'] = next_marker
+        return response
+
+    def elbv2_describe_tags(self, ResourceArns):
+        missing = filter(lambda x: x not in self.load_balancers_v2, ResourceArns)
+        if missing:
+            raise ServiceError('LoadBalancerNotFound', 'One or more load balancers not found')
+        return {'TagDescriptions': map(lambda x: {'ResourceArn': x, 'Tags': self.load_balancers_v2[x]['tags']},
+                                       ResourceArns)}
+
+    # STS
+
+    def sts_assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        self.assumed_roles.append(RoleArn)
+        return {
+            'Credentials': {
+                'AccessKeyId': self.new_id('ASIA', 16).upper(),
+                'SecretAccessKey': 'standins',
+                'SessionToken': 'standins',
+                'Expiration': datetime.utcfromtimestamp(int(time.time()) + self.credential_seconds)
+            },
+            'AssumedRoleUser': {'AssumedRoleId': self.new_id('AROA', 16).upper() + ':' + RoleSessionName,
+                                'Arn': RoleArn.replace(':iam:', ':sts:').replace(':role/', ':assumed-role/') + '/' + RoleSessionName}
+        }
+
+    # DynamoDB, which is called with and answers in its low-level attribute value format
+
+    def get_table(self, TableName):
+        if TableName not in self.tables:
+            raise ServiceError('ResourceNotFoundException', 'Requested resource not found: Table: %s not found' % TableName)
+        return self.tables[TableName]
+
+    def table_description(self, table):
+        description = dict((key, value) for key, value in table.items() if key not in ('items', 'TimeToLiveSpecification'))
+        description['ItemCount'] = len(table['items'])
+        return description
+
+    def item_key(self, table, key):
+        return tuple(map(lambda x: tuple(key[x['AttributeName']].items()[0]), table['KeySchema']))
+
+    def attribute_value(self, value):
+        """Returns a low-level DynamoDB value in a form that can be compared."""
+        if 'N' in value:
+            return Decimal(value['N'])
+        return value.values()[0]
+
+    def check_condition(self, item, ConditionExpression=None, ExpressionAttributeNames=None,
+                        ExpressionAttributeValues=None, **kwargs):
+        """Raises ConditionalCheckFailedException unless the item meets the condition.  Conditions made of
+        attribute_exists, attribute_not_exists and comparisons with a value, joined by AND or OR, are understood."""
+        if not ConditionExpression:
+            return
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        item = item or {}
+
+        def term(text):
+            text = text.strip()
+            function = re.match(r'^(attribute_exists|attribute_not_exists)\s*\(\s*(\S+?)\s*\)$', text)
+            if function:
+                exists = names.get(function.group(2), function.group(2)) in item
+                return exists if function.group(1) == 'attribute_exists' else not exists
+            comparison = re.match(r'^(\S+)\s*(=|<>|<=|>=|<|>)\s*(:\w+)$', text)
+            if not comparison:
+                raise NotImplementedError('The stand-ins do not understand the condition %s' % text)
+            name = names.get(comparison.group(1), comparison.group(1))
+            if name not in item:
+                return comparison.group(2) == '<>'
+            left = self.attribute_value(item[name])
+            right = self.attribute_value(values[comparison.group(3)])
+            return {'=': left == right, '<>': left != right, '<': left < right, '<=': left <= right,
+                    '>': left > right, '>=': left >= right}[comparison.group(2)]
+
+        if not any(all(map(term, re.split(r'\s+AND\s+', x))) for x in re.split(r'\s+OR\s+', ConditionExpression)):
+            raise ServiceError('ConditionalCheckFailedException', 'The conditional request failed')
+
+    def dynamodb_describe_table(self, TableName):
+        return {'Table': self.table_description(self.get_table(TableName))}
+
+    def dynamodb_create_table(self, TableName, AttributeDefinitions, KeySchema, **kwargs):
+        if TableName in self.tables:
+            raise ServiceError('ResourceInUseException', 'Table already exists: %s' % TableName)
+        table = {'TableName': TableName, 'TableStatus': 'ACTIVE', 'AttributeDefinitions': AttributeDefinitions,
+                 'KeySchema': KeySchema, 'CreationDateTime': datetime.utcnow(), 'items': {}}
+        for key, value in kwargs.items():
+            if key in ('GlobalSecondaryIndexes', 'LocalSecondaryIndexes', 'BillingMode', 'ProvisionedThroughput'):
+                table[key] = value
+        self.tables[TableName] = table
+        return {'TableDescription': self.table_description(table)}
+
+    def dynamodb_update_time_to_live(self, TableName, TimeToLiveSpecification):
+        self.get_table(TableName)['TimeToLiveSpecification'] = TimeToLiveSpecification
+        return {'TimeToLiveSpecification': TimeToLiveSpecification}
+
+    def dynamodb_put_item(self, TableName, Item, **kwargs):
+        table = self.get_table(TableName)
+        with self.lock:
+            self.check_condition(table['items'].get(self.item_key(table, Item)), **kwargs)
+            table['items'][self.item_key(table, Item)] = Item
+        return {}
+
+    def dynamodb_update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames=None,
+                             ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        """Applies SET and REMOVE clauses.  SET values can be a value, an attribute, if_not_exists, list_append and
+        the sum or difference of two of them."""
+        table = self.get_table(TableName)
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+
+        def split_top_level(text):
+            parts, depth, start = [], 0, 0
+            for i, character in enumerate(text):
+                depth += {'(': 1, ')': -1}.get(character, 0)
+                if character == ',' and depth == 0:
+                    parts.append(text[start:i].strip())
+                    start = i + 1
+            parts.append(text[start:].strip())
+            return parts
+
+        def operand(text, item):
+            text = text.strip()
+            function = re.match(r'^(if_not_exists|list_append)\s*\((.*)\)$', text)
+            if function:
+                arguments = split_top_level(function.group(2))
+                if function.group(1) == 'if_not_exists':
+                    name = names.get(arguments[0], arguments[0])
+                    return item[name] if name in item else operand(arguments[1], item)
+                return {'L': operand(arguments[0], item)['L'] + operand(arguments[1], item)['L']}
+            arithmetic = re.match(r'^(.+?)\s*([+-])\s*(.+)$', text)
+            if arithmetic:
+                left = Decimal(operand(arithmetic.group(1), item)['N'])
+                right = Decimal(operand(arithmetic.group(3), item)['N'])
+                return {'N': str(left + right if arithmetic.group(2) == '+' else left - right)}
+            if text.startswith(':'):
+                return values[text]
+            return item[names.get(text, text)]
+
+        with self.lock:
+            key = self.item_key(table, Key)
+            old_item = table['items'].get(key)
+            self.check_condition(old_item, ExpressionAttributeNames=ExpressionAttributeNames,
+                                 ExpressionAttributeValues=ExpressionAttributeValues, **kwargs)
+            item = dict(old_item or Key)
+            for action, clause in re.findall(r'(SET|REMOVE)\s+(.*?)(?=\s+(?:SET|REMOVE)\s+|$)', UpdateExpression.strip()):
+                for part in split_top_level(clause):
+                    if action == 'REMOVE':
+                        item.pop(names.get(part, part), None)
+                    else:
+                        name, value = part.split('=', 1)
+                        item[names.get(name.strip(), name.strip())] = operand(value, item)
+            table['items'][key] = item
+        if ReturnValues == 'ALL_OLD' and old_item is not None:
+            return {'Attributes': old_item}
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': item}
+        return {}
+
+    def dynamodb_get_item(self, TableName, Key, AttributesToGet=None, **kwargs):
+        item = self.get_table(TableName)['items'].get(self.item_key(self.get_table(TableName), Key))
+        if item is not None and AttributesToGet:
+            item = dict((key, value) for key, value in item.items() if key in AttributesToGet)
+        return {'Item': item} if item is not None else {}
+
+    def dynamodb_delete_item(self, TableName, Key, ReturnValues='NONE', **kwargs):
+        table = self.get_table(TableName)
+        with self.lock:
+            self.check_condition(table['items'].get(self.item_key(table, Key)), **kwargs)
+            old_item = table['items'].pop(self.item_key(table, Key), None)
+        if ReturnValues == 'ALL_OLD' and old_item is not None:
+            return {'Attributes': old_item}
+        return {}
+
+    def dynamodb_query(self, TableName, KeyConditionExpression, ExpressionAttributeValues, IndexName=None,
+                       ExpressionAttributeNames=None, ExclusiveStartKey=None, Limit=None, **kwargs):
+        """Answers queries whose key condition compares the hash key, and optionally the range key, with a value."""
+        table = self.get_table(TableName)
+        key_schema = table['KeySchema']
+        if IndexName is not None:
+            key_schema = filter(lambda x: x['IndexName'] == IndexName, table.get('GlobalSecondaryIndexes', []))[0]['KeySchema']
+        names = ExpressionAttributeNames or {}
+        conditions = []
+        for term in re.split(r'\s+AND\s+', KeyConditionExpression):
+            comparison = re.match(r'^\s*(\S+)\s*=\s*(:\w+)\s*$', term)
+            if not comparison:
+                raise NotImplementedError('The stand-ins do not understand the key condition %s' % term)
+            conditions.append((names.get(comparison.group(1), comparison.group(1)),
+                               self.attribute_value(ExpressionAttributeValues[comparison.group(2)])))
+        items = filter(lambda x: all(name in x and self.attribute_value(x[name]) == value for name, value in conditions),
+                       table['items'].values())
+        sort_names = map(lambda x: x['AttributeName'], key_schema) + map(lambda x: x['AttributeName'], table['KeySchema'])
+        items.sort(key=lambda x: map(lambda name: self.attribute_value(x[name]) if name in x else None, sort_names))
+        if ExclusiveStartKey is not None:
+            start = map(lambda name: self.attribute_value(ExclusiveStartKey[name]), sort_names)
+            items = filter(lambda x: map(lambda name: self.attribute_value(x[name]), sort_names) > start, items)
+        response = {'Items': items, 'Count': len(items), 'ScannedCount': len(items)}
+        if Limit is not None and len(items) > Limit:
+            response['Items'] = items[:Limit]
+            response['Count'] = response['ScannedCount'] = Limit
+            response['LastEvaluatedKey'] = dict(map(lambda name: (name, items[Limit - 1][name]), set(sort_names)))
+        return response
+
+    def dynamodb_batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.get_table(table_name)
+            items = map(lambda x: table['items'].get(self.item_key(table, x)), request['Keys'])
+            responses[table_name] = filter(None, items)
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def dynamodb_batch_write_item(self, RequestItems, **kwargs):
+        for table_name, requests in RequestItems.items():
+            table = self.get_table(table_name)
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    table['items'][self.item_key(table, item)] = item
+                else:
+                    table['items'].pop(self.item_key(table, request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': {}}
+
+
+class FakeContext(object):
+    """Stands in for the Lambda context object."""
+
+    def __init__(self, timeout=90):
+        self.deadline = time.time() + timeout
+        self.aws_request_id = '%032x' % random.getrandbits(128)
+        self.function_name = 'ddns_lambda'
+        self.invoked_function_arn = 'arn:aws:lambda:us-east-1:%s:function:ddns_lambda' % ACCOUNT_ID
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.time()) * 1000))
+
+
+# CloudWatch events like the ones the rules in ddns.template route to the function
+
+def ec2_event(instance_id, state, region='us-east-1', event_time='2020-01-01T00:00:00Z'):
+    return {
+        'version': '0',
+        'id': '%032x' % random.getrandbits(128),
+        'detail-type': 'EC2 Instance State-change Notification',
+        'source': 'aws.ec2',
+        'account': ACCOUNT_ID,
+        'time': event_time,
+        'region': region,
+        'resources': ['arn:aws:ec2:%s:%s:instance/%s' % (region, ACCOUNT_ID, instance_id)],
+        'detail': {'instance-id': instance_id, 'state': state}
+    }
+
+
+def cloudtrail_event(event_name, request_parameters, response_elements, api_version, region='us-east-1',
+                     event_time='2020-01-01T00:00:00Z'):
+    return {
+        'version': '0',
+        'id': '%032x' % random.getrandbits(128),
+        'detail-type': 'AWS API Call via CloudTrail',
+        'source': 'aws.elasticloadbalancing',
+        'account': ACCOUNT_ID,
+        'time': event_time,
+        'region': region,
+        'resources': [],
+        'detail': {
+            'eventVersion': '1.05',
+            'eventTime': event_time,
+            'eventSource': 'elasticloadbalancing.amazonaws.com',
+            'eventName': event_name,
+            'awsRegion': region,
+            'requestParameters': request_parameters,
+            'responseElements': response_elements,
+            'apiVersion': api_version,
+            'eventType': 'AwsApiCall'
+        }
+    }
+
+
+def lbv1_event(standins, name, event_name, event_time='2020-01-01T00:00:00Z'):
+    response_elements = None
+    if event_name == 'CreateLoadBalancer':
+        response_elements = {'dNSName': standins.load_balancers[name]['description']['DNSName']}
+    return cloudtrail_event(event_name, {'loadBalancerName': name}, response_elements, '2012-06-01',
+                            standins.region, event_time)
+
+
+def lbv2_event(standins, arn, event_name, event_time='2020-01-01T00:00:00Z'):
+    description = standins.load_balancers_v2[arn]['description']
+    if event_name == 'CreateLoadBalancer':
+        request_parameters = {'name': description['LoadBalancerName'], 'scheme': description['Scheme'],
+                              'type': description['Type']}
+        response_elements = {'loadBalancers': [{
+            'loadBalancerArn': arn,
+            'loadBalancerName': description['LoadBalancerName'],
+            'dNSName': description['DNSName'],
+            'scheme': description['Scheme'],
+            'vpcId': description['VpcId'],
+            'type': description['Type'],
+            'state': {'code': 'provisioning'}
+        }]}
+    else:
+        request_parameters = {'loadBalancerArn': arn}
+        response_elements = None
+    return cloudtrail_event(event_name, request_parameters, response_elements, '2015-12-01', standins.region,
+                            event_time)
@@ -1,52 +1,712 @@
+import base64
+import calendar
+import binascii
+import hashlib
 import json
+import os
 import boto3
 import re
 import uuid
 import time
 import random
+import socket
 import sys
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from decimal import Decimal
+from functools import wraps
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 print('Loading function ' + datetime.now().time().isoformat())
-route53 = boto3.client('route53')
-ec2 = boto3.resource('ec2')
-compute = boto3.client('ec2')
-elb = boto3.client('elb')
-elbv2 = boto3.client('elbv2')
-dynamodb_client = boto3.client('dynamodb')
-dynamodb_resource = boto3.resource('dynamodb')
 
+# Clients and resources are created from one shared session the first time they are used, so that an event only pays
+# for loading the service models it actually needs.  Connections are pooled and kept alive between warm invocations.
+aws_session = None
+aws_session_lock = threading.RLock()
+
+def get_aws_session():
+    """Returns the boto3 session that all clients and resources are created from."""
+    global aws_session
+    with aws_session_lock:
+        if aws_session is None:
+            aws_session = boto3.session.Session()
+            if METRICS_ENABLED:
+                aws_session.events.register('before-parameter-build', start_call_metrics)
+                aws_session.events.register('after-call', finish_call_metrics)
+                aws_session.events.register('after-call-error', fail_call_metrics)
+        return aws_session
+
+def get_client_config():
+    """Returns the botocore configuration for new clients and resources."""
+    max_pool_connections = max(10, FANOUT_WORKERS)
+    try:
+        return Config(max_pool_connections=max_pool_connections, tcp_keepalive=True)
+    except TypeError:
+        # botocore only supports tcp_keepalive since version 1.27
+        return Config(max_pool_connections=max_pool_connections)
+
+class LazyClient(object):
+    """Stands in for a boto3 client or resource and creates it from the shared session the first time it is used.
+    While an event from another account or region is processed, it stands in for the pooled client of that account
+    and region instead, unless home is set."""
+    def __init__(self, service_name, resource=False, home=False):
+        self.service_name = service_name
+        self.resource = resource
+        self.home = home
+        self.instance = None
+
+    def get(self):
+        if client_target is not None and not self.home:
+            return get_target_client(client_target, self.service_name, self.resource)
+        if self.instance is None:
+            # Creating clients from the same session isn't thread safe
+            with aws_session_lock:
+                if self.instance is None:
+                    if self.resource:
+                        self.instance = get_aws_session().resource(self.service_name, config=get_client_config())
+                    else:
+                        self.instance = get_aws_session().client(self.service_name, config=get_client_config())
+        return self.instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+route53 = LazyClient('route53')
+compute = LazyClient('ec2')
+elb = LazyClient('elb')
+elbv2 = LazyClient('elbv2')
+dynamodb_client = LazyClient('dynamodb', home=True)
+dynamodb_resource = LazyClient('dynamodb', resource=True, home=True)
+sts = LazyClient('sts', home=True)
+
+# Events forwarded from other accounts and regions, e.g. through an event bus, are handled with clients for the account
+# and region of the event; the DDNS table stays in the function's own account and region.  In another account the role
+# named DDNS_ROLE_NAME is assumed, and its credentials are cached and assumed again CREDENTIALS_REFRESH seconds before
+# they expire, or halfway through their lifetime if that is shorter.  Without a role name the function's own credentials
+# are used in every account.  The clients of up to DDNS_CLIENT_POOL_SIZE (account, region) pairs are kept for warm
+# invocations; the least recently used are dropped.
+ROLE_NAME = os.environ.get('DDNS_ROLE_NAME', '')
+CLIENT_POOL_SIZE = int(os.environ.get('DDNS_CLIENT_POOL_SIZE', '16'))
+CREDENTIALS_REFRESH = 300
+client_target = None
+client_pool = OrderedDict()
+assumed_credentials = {}
+
+def get_client_target(account_id, target_region, context=None):
+    """Returns the (account id, region) pair to create clients for, or None for the function's own account and
+    region.  The account id is None for the function's own account."""
+    try:
+        if account_id == context.invoked_function_arn.split(':')[4]:
+            account_id = None
+    except (AttributeError, IndexError):
+        pass
+    if target_region == get_aws_session().region_name:
+        target_region = None
+    if account_id is None and target_region is None:
+        return None
+    return (account_id, target_region or get_aws_session().region_name)
+
+def get_partition(partition_region):
+    """Returns the partition of the region, e.g. aws-cn for cn-north-1."""
+    if partition_region.startswith('cn-'):
+        return 'aws-cn'
+    if partition_region.startswith('us-gov-'):
+        return 'aws-us-gov'
+    return 'aws'
+
+def get_account_credentials(account_id, partition_region):
+    """Returns the client keyword arguments with the credentials of the role assumed in the account and when they are
+    to be refreshed, or no arguments and None for the function's own credentials.  The role is assumed without holding
+    aws_session_lock, so that the clients of other targets aren't held up by the AssumeRole call."""
+    if account_id is None or not ROLE_NAME:
+        return {}, None
+    with aws_session_lock:
+        entry = assumed_credentials.get(account_id)
+    if entry is None or time.time() >= entry['refresh']:
+        role_arn = 'arn:%s:iam::%s:role/%s' % (get_partition(partition_region), account_id, ROLE_NAME)
+        print 'Assuming role %s' % role_arn
+        credentials = sts.assume_role(RoleArn=role_arn, RoleSessionName='ddns-lambda')['Credentials']
+        expires = calendar.timegm(credentials['Expiration'].utctimetuple())
+        entry = {
+            'refresh': expires - min(CREDENTIALS_REFRESH, (expires - time.time()) / 2),
+            'kwargs': {
+                'aws_access_key_id': credentials['AccessKeyId'],
+                'aws_secret_access_key': credentials['SecretAccessKey'],
+                'aws_session_token': credentials['SessionToken']
+            }
+        }
+        with aws_session_lock:
+            assumed_credentials[account_id] = entry
+    return entry['kwargs'], entry['refresh']
+
+def get_target_client(target, service_name, resource=False):
+    """Returns the pooled client or resource of the service for the (account id, region) pair, creating it, and the
+    pool entry of the pair, if there isn't one or its credentials are to be refreshed."""
+    with aws_session_lock:
+        entry = client_pool.get(target)
+    if entry is None or entry['refresh'] is not None and time.time() >= entry['refresh']:
+        # Assumes the role, if there is one, before taking the lock; when two threads do so for the same pair the
+        # entry of the last one is kept
+        credentials, refresh = get_account_credentials(target[0], target[1])
+        entry = {'credentials': credentials, 'refresh': refresh, 'clients': {}}
+    with aws_session_lock:
+        current = client_pool.pop(target, None)
+        if current is not None and current['credentials'] == entry['credentials']:
+            entry = current
+        # The most recently used pair goes last, so the least recently used is dropped first
+        client_pool[target] = entry
+        while len(client_pool) > CLIENT_POOL_SIZE:
+            client_pool.popitem(last=False)
+        key = (service_name, resource)
+        if key not in entry['clients']:
+            create = get_aws_session().resource if resource else get_aws_session().client
+            entry['clients'][key] = create(service_name, region_name=target[1], config=get_client_config(),
+                                           **entry['credentials'])
+        return entry['clients'][key]
+
+# Hosted zones are cached for the life of the container so that warm invocations don't have to look them up in Route 53
+# again.  'tries' holds, per account, the hosted zones looked up so far in a trie keyed by the labels of the zone name
+# from right to left, so that both a zone name and the zones a host name belongs to are found in as many steps as the
+# name has labels.  Zones are only looked up for the names the assets use: a name that no lookup has covered yet lists
+# a page of up to MAX_ZONE_LOOKUP_ITEMS zones from that name on, in the order Route 53 lists them by, and the trie
+# remembers the range of names the page covers, so that later names in that range, with or without a zone, need no
+# call.  The calls thus grow with the names the assets use rather than with the zones in the account.
+# 'vpcs' maps a (region, VPC id) pair to the private zones associated with the VPC and 'associations' maps a zone id to
+# the (region, VPC id) pairs known to be associated with the zone.  'subnets' maps a subnet id to the reverse lookup
+# zones of its IPv4 and IPv6 CIDR blocks once they are known to be associated with the subnet's VPC, so that instances
+# launched into the subnet again don't need its CIDR blocks or any zone lookups.  The tries are emptied and the other
+# entries expire after DDNS_ZONE_CACHE_TTL seconds.  Zones that this function creates are added to the index.
+ZONE_CACHE_TTL = int(os.environ.get('DDNS_ZONE_CACHE_TTL', '300'))
+MAX_ZONE_LOOKUP_ITEMS = 100
+hosted_zone_index = {
+    'tries': {},
+    'vpcs': {},
+    'associations': {},
+    'subnets': {}
+}
+hosted_zone_trie_lock = threading.Lock()
+
+# Route 53 changes are collected per hosted zone while an event is processed and then submitted with one
+# ChangeResourceRecordSets call per zone.  A batch is split only when it would exceed the Route 53 limits on the number
+# of resource records and on the total length of their values; an UPSERT counts twice towards both limits.
+MAX_CHANGE_BATCH_RECORDS = 1000
+MAX_CHANGE_BATCH_VALUE_CHARS = 32000
+change_plan = {}
+
+# Route 53 allows five requests per second per account.  A change batch that is throttled is submitted again after a
+# delay with exponential backoff and decorrelated jitter, for as long as it can be retried at least
+# ROUTE53_RETRY_RESERVE seconds before the invocation times out.  Each container also spaces its change batches by a
+# delay that doubles when one is throttled and halves when one succeeds.  With DDNS_ROUTE53_RATE set to a number of
+# requests per second, every change batch first takes a token from a bucket in the DDNS table that refills at that
+# rate, so that all containers together stay under it.  A container that loses the race for a token to another one
+# tries again after up to ROUTE53_TOKEN_CONFLICT_DELAY seconds, chosen at random.
+ROUTE53_RETRY_ERRORS = ('Throttling', 'ThrottlingException', 'PriorRequestNotComplete')
+ROUTE53_RETRY_BASE_DELAY = 0.25
+ROUTE53_RETRY_MAX_DELAY = 10
+ROUTE53_RETRY_RESERVE = 2
+ROUTE53_RATE = float(os.environ.get('DDNS_ROUTE53_RATE', '0'))
+ROUTE53_TOKEN_BUCKET_KEY = 'route53-token-bucket'
+ROUTE53_TOKEN_CONFLICT_DELAY = 0.2
+route53_write_spacing = 0
+invocation_deadline = None
+
+# With DDNS_COALESCE_WRITES set to true, lambda_handler doesn't submit its changes itself.  It appends them to a queue
+# item per zone in the DDNS table and tries to take the zone's lease.  The invocation that gets the lease waits
+# DDNS_COALESCE_WINDOW seconds for other invocations to queue their changes, then submits everything queued as merged
+# change batches until the queue is empty.  A burst of launches thus makes a few large Route 53 writes instead of one
+# small write per instance.  Leases expire when their holder's invocation would have timed out.  Changes that are
+# rejected or can't be submitted before the deadline go back into the queue, and an event is only recorded as applied
+# by the invocation that submitted its changes.
+COALESCE_WRITES = os.environ.get('DDNS_COALESCE_WRITES', 'false').lower() == 'true'
+COALESCE_WINDOW = float(os.environ.get('DDNS_COALESCE_WINDOW', '1'))
+change_leases = {}
+
+# VPC DNS attributes, DHCP options and subnet CIDR blocks rarely change, so they are cached for DDNS_VPC_CACHE_TTL
+# seconds, keyed by VPC or subnet id.  With DDNS_VPC_CACHE_SHARED set to true the entries are also kept in the DDNS
+# table, so that new containers can use what other containers have already looked up.
+VPC_CACHE_TTL = int(os.environ.get('DDNS_VPC_CACHE_TTL', '3600'))
+VPC_CACHE_SHARED = os.environ.get('DDNS_VPC_CACHE_SHARED', 'false').lower() == 'true'
+vpc_metadata_cache = {}
+
+# Independent AWS calls of an event are made at the same time on up to DDNS_FANOUT_WORKERS threads.  The boto3
+# clients they use are thread safe.  Set it to 1 to make the calls one after another.
+FANOUT_WORKERS = int(os.environ.get('DDNS_FANOUT_WORKERS', '8'))
+
+# Tables that this container has already found or created, so that they aren't checked on every invocation.  A table
+# is checked again after DynamoDB reports that it doesn't exist.  New tables use DDNS_TABLE_BILLING_MODE, which is
+# either PROVISIONED, with 4 read and 4 write capacity units, or PAY_PER_REQUEST.
+TABLE_BILLING_MODE = os.environ.get('DDNS_TABLE_BILLING_MODE', 'PROVISIONED')
+known_tables = set()
+
+# What is stored in the AssetAttributes of a new asset: 'slim' keeps the tags and extras that the destroy path reads,
+# 'full' also keeps the whole describe response.
+ASSET_ATTRIBUTES = os.environ.get('DDNS_ASSET_ATTRIBUTES', 'slim')
+
+# CloudWatch events are delivered at least once and not always in order.  lambda_handler claims the item of the asset
+# for each event with a conditional write that fails if a newer event has been claimed, and records the id of the event
+# and a hash of the records it applied once they are submitted.  An event that has already been applied, or that is
+# older than the last one claimed, is skipped before the asset is described, and a create event whose records hash the
+# same as the applied ones submits nothing to Route 53.  A destroyed asset's item is kept as a tombstone, so that a late
+# create event can't recreate its records, until DynamoDB expires it DDNS_TOMBSTONE_TTL seconds later.  The claims
+# of the invocation are checked again before each change batch, and a create event whose claim a destroy event took
+# over while its UPSERTs were being submitted deletes the records it wrote.
+TOMBSTONE_TTL = int(os.environ.get('DDNS_TOMBSTONE_TTL', '86400'))
+event_claims = {}
+
+# The records that lambda_handler and batch_handler apply for an asset are indexed in the DDNSRecords table, one item
+# per record keyed by the asset id and a record key made of the zone id, name, type and value.  Each item also holds
+# the VPC of the asset and the account and region the record was written with, and the ZoneId and VpcId indexes find
+# the records of a zone or of the assets in a VPC.  The destroy event of an asset queries its records and deletes
+# exactly those, without reading its attributes or looking up any zones; assets without indexed records fall back to
+# working their records out again.  records_handler lists or purges the records of a zone or a VPC.
+RECORD_TABLE_NAME = 'DDNSRecords'
+RECORD_ZONE_INDEX = 'ZoneId'
+RECORD_VPC_INDEX = 'VpcId'
+
+# On create events the asset is described until it has the attributes needed for its DNS records.  In 'poll' mode
+# the describe call is retried with capped exponential backoff and jitter for up to DDNS_READY_TIMEOUT seconds, always
+# leaving DDNS_READY_RESERVE seconds of the invocation for the DNS work.  'sleep' mode waits DDNS_READY_TIMEOUT seconds
+# and describes the asset once.
+WAIT_MODE = os.environ.get('DDNS_WAIT_MODE', 'poll')
+READY_TIMEOUT = float(os.environ.get('DDNS_READY_TIMEOUT', '60'))
+READY_RESERVE = float(os.environ.get('DDNS_READY_RESERVE', '20'))
+READY_POLL_BASE_DELAY = 0.5
+READY_POLL_MAX_DELAY = 8
+READY_NOT_FOUND_ERRORS = ('InvalidInstanceID.NotFound', 'LoadBalancerNotFound')
+
+# batch_handler describes the instances and fetches the DynamoDB items of a whole batch up front, and
+# reconcile_handler describes a page of instances at a time.  The responses are kept here, keyed by asset id, until the
+# event for that asset is processed.  Load balancers are kept in load_balancer_cache instead.
+MAX_DESCRIBE_INSTANCE_IDS = 1000
+MAX_BATCH_GET_KEYS = 100
+MAX_DESCRIBE_LOAD_BALANCERS = 400
+MAX_DESCRIBE_LOAD_BALANCER_TAGS = 20
+batch_prefetch = {
+    'descriptions': {},
+    'items': {}
+}
+
+# The descriptions and tags of load balancers are cached for DDNS_LB_CACHE_TTL seconds, keyed by the name of a classic
+# load balancer or the ARN of a v2 one, so that the events of a load balancer whose metadata batch_handler or
+# reconcile_handler has fetched, or that is created again, don't describe it again.  Several load balancers are
+# described, and their tags fetched, with one call of each for up to MAX_DESCRIBE_LOAD_BALANCER_TAGS of them.
+LB_CACHE_TTL = int(os.environ.get('DDNS_LB_CACHE_TTL', '300'))
+load_balancer_cache = {}
+
+# With DDNS_METRICS set to true every AWS call is timed through the botocore event hooks of the shared session, and
+# every invocation ends with one line in CloudWatch embedded metric format, in the DDNS_METRICS_NAMESPACE namespace,
+# with the number of calls, retries, throttles and errors, and the calls and time of each phase.  Calls are assigned
+# to a phase by their operation.  Nothing is hooked when it is false.  With DDNS_LOG_LEVEL set to quiet the progress
+# messages aren't printed, so that large bursts don't flood CloudWatch Logs; the metrics line still is, and so are the
+# errors, which are printed to stderr.
+METRICS_ENABLED = os.environ.get('DDNS_METRICS', 'false').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('DDNS_METRICS_NAMESPACE', 'DDNS')
+LOG_LEVEL = os.environ.get('DDNS_LOG_LEVEL', 'verbose')
+METRIC_PHASES = {
+    'DescribeInstances': 'AssetFetch',
+    'DescribeLoadBalancers': 'AssetFetch',
+    'DescribeTags': 'AssetFetch',
+    'GetItem': 'AssetFetch',
+    'BatchGetItem': 'AssetFetch',
+    'Query': 'AssetFetch',
+    'ListHostedZonesByName': 'ZoneDiscovery',
+    'ListHostedZonesByVPC': 'ZoneDiscovery',
+    'GetHostedZone': 'ZoneDiscovery',
+    'CreateHostedZone': 'ZoneDiscovery',
+    'AssociateVPCWithHostedZone': 'ZoneDiscovery',
+    'DescribeVpcAttribute': 'VpcChecks',
+    'DescribeVpcs': 'VpcChecks',
+    'DescribeDhcpOptions': 'VpcChecks',
+    'DescribeSubnets': 'VpcChecks',
+    'ChangeResourceRecordSets': 'RecordWrites',
+    'PutItem': 'RecordWrites',
+    'DeleteItem': 'RecordWrites',
+    'BatchWriteItem': 'RecordWrites'
+}
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+                     'RequestThrottled', 'RequestThrottledException', 'TooManyRequestsException',
+                     'ProvisionedThroughputExceededException', 'PriorRequestNotComplete', 'SlowDown')
+invocation_metrics = None
+invocation_metrics_lock = threading.Lock()
+
+def start_call_metrics(model, context, **kwargs):
+    """Notes when an AWS call started.  Registered for botocore's before-parameter-build event."""
+    context['ddns_operation'] = (model.service_model.service_name, model.name)
+    context['ddns_start'] = time.time()
+
+def finish_call_metrics(http_response, parsed, context, **kwargs):
+    """Records an AWS call that got a response.  Registered for botocore's after-call event."""
+    error_code = None
+    if http_response.status_code >= 300:
+        error_code = parsed.get('Error', {}).get('Code', str(http_response.status_code))
+    record_call_metrics(context, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0), error_code)
+
+def fail_call_metrics(exception, context, **kwargs):
+    """Records an AWS call that didn't get a response.  Registered for botocore's after-call-error event."""
+    record_call_metrics(context, 0, type(exception).__name__)
+
+def record_call_metrics(context, retries, error_code):
+    """Adds an AWS call to the metrics of the invocation."""
+    if invocation_metrics is None or 'ddns_start' not in context:
+        return
+    milliseconds = (time.time() - context['ddns_start']) * 1000
+    service_name, operation_name = context['ddns_operation']
+    with invocation_metrics_lock:
+        operation = invocation_metrics['operations'].setdefault(service_name + '.' + operation_name,
+            {'Calls': 0, 'Time': 0.0, 'Retries': 0, 'Throttles': 0, 'Errors': 0})
+        operation['Calls'] += 1
+        operation['Time'] += milliseconds
+        operation['Retries'] += retries
+        if error_code in THROTTLING_ERRORS:
+            operation['Throttles'] += 1
+        if error_code is not None:
+            operation['Errors'] += 1
+        phase = invocation_metrics['phases'].setdefault(METRIC_PHASES.get(operation_name, 'Other'), {'Calls': 0, 'Time': 0.0})
+        phase['Calls'] += 1
+        phase['Time'] += milliseconds
+
+def emit_invocation_metrics(handler_name, start, stream):
+    """Writes the metrics of the invocation to the stream as one line in CloudWatch embedded metric format."""
+    document = {
+        'Handler': handler_name,
+        'Duration': (time.time() - start) * 1000,
+        'AwsCalls': 0,
+        'AwsRetries': 0,
+        'AwsThrottles': 0,
+        'AwsErrors': 0,
+        'Operations': invocation_metrics['operations']
+    }
+    for operation in invocation_metrics['operations'].values():
+        document['AwsCalls'] += operation['Calls']
+        document['AwsRetries'] += operation['Retries']
+        document['AwsThrottles'] += operation['Throttles']
+        document['AwsErrors'] += operation['Errors']
+    metrics = [{'Name': 'Duration', 'Unit': 'Milliseconds'}]
+    metrics.extend(map(lambda x: {'Name': x, 'Unit': 'Count'}, ['AwsCalls', 'AwsRetries', 'AwsThrottles', 'AwsErrors']))
+    for phase_name in sorted(set(METRIC_PHASES.values())) + ['Other']:
+        phase = invocation_metrics['phases'].get(phase_name, {'Calls': 0, 'Time': 0.0})
+        document[phase_name + 'Calls'] = phase['Calls']
+        document[phase_name + 'Time'] = phase['Time']
+        metrics.append({'Name': phase_name + 'Calls', 'Unit': 'Count'})
+        metrics.append({'Name': phase_name + 'Time', 'Unit': 'Milliseconds'})
+    document['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE, 'Dimensions': [['Handler']], 'Metrics': metrics}]
+    }
+    stream.write(json.dumps(document) + '\n')
+
+class QuietStream(object):
+    """Stands in for sys.stdout and drops what is printed to it.  Errors are printed to sys.stderr and still get
+    through."""
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+def instrumented(handler):
+    """Wraps a handler so that it emits the metrics of the invocation and prints nothing but them and the errors when
+    DDNS_LOG_LEVEL is quiet.  Returns the handler itself when neither is needed."""
+    if not METRICS_ENABLED and LOG_LEVEL != 'quiet':
+        return handler
+    @wraps(handler)
+    def instrumented_handler(event, context):
+        global invocation_metrics
+        start = time.time()
+        stream = sys.stdout
+        if METRICS_ENABLED:
+            invocation_metrics = {'operations': {}, 'phases': {}}
+        if LOG_LEVEL == 'quiet':
+            sys.stdout = QuietStream()
+        try:
+            return handler(event, context)
+        finally:
+            sys.stdout = stream
+            if METRICS_ENABLED:
+                emit_invocation_metrics(handler.__name__, start, stream)
+                invocation_metrics = None
+    return instrumented_handler
+
+@instrumented
 def lambda_handler(event, context):
-    """ Check to see whether a DynamoDB table already exists.  If not, create it.  This table is used to keep a record of
-    assets that have been created along with their attributes.  This is necessary because when you terminate it
-    its attributes are no longer available, so they have to be fetched from the table."""
-    global table, asset_id, asset, event_state, region
+    """Updates DNS for a single CloudWatch event about an EC2 instance or a load balancer."""
+    global table, change_plan, invocation_deadline, event_claims
+    change_plan = {}
+    event_claims = {}
+    invocation_deadline = get_invocation_deadline(context)
+    table = get_table('DDNS')
+
+    # Skip the event if it has already been applied or a newer event for the asset has been claimed
+    stored_item = begin_event(event, table)
+    if stored_item is None:
+        return
+    if get_event_state(event) == 'destroy':
+        if 'AssetAttributes' not in stored_item:
+            # The asset's create event hasn't been applied, so there are no records to delete
+            print 'No records stored for %s' % get_event_asset_id(event)
+            finish_event(event, table)
+            return
+        # Delete exactly the records that were applied for the asset if they are indexed
+        indexed_records = get_asset_records(get_event_asset_id(event))
+        if indexed_records:
+            if delete_records(indexed_records, coalesce=COALESCE_WRITES):
+                return
+            finish_event(event, table)
+            return
+        batch_prefetch['items'][get_event_asset_id(event)] = stored_item
+
+    try:
+        if not process_event(event, context):
+            return
+    except SystemExit:
+        # Index and submit the changes planned before the event was cut short
+        if event_state == 'create':
+            update_record_index(get_planned_records({asset_id: asset['extras']['vpc_id']}))
+        flush_change_plan(coalesce=COALESCE_WRITES)
+        raise
+    finally:
+        batch_prefetch['items'] = {}
+
+    records = []
+    if event_state == 'create':
+        records = get_planned_records({asset_id: asset['extras']['vpc_id']})
+    records_hash = get_change_plan_hash(change_plan)
+    stale_records = []
+    if (event_state == 'create' and stored_item.get('Applied') and not stored_item.get('Destroyed') and
+            stored_item.get('RecordsHash') == records_hash):
+        print 'The records of %s are unchanged since event %s' % (asset_id, stored_item['EventId'])
+        change_plan = {}
+    elif event_state == 'create' and stored_item.get('RecordsHash'):
+        # The asset's records have changed since they were applied, e.g. because its tags have
+        stale_records = plan_stale_record_deletes(asset_id, records)
+    # Index the records before they are submitted, so that the asset's destroy event finds them even if this
+    # invocation doesn't get to finish
+    update_record_index(records)
+
+    # Submit the planned A, PTR and CNAME changes to Route 53.  Some of them may have been submitted before a destroy
+    # event claimed the asset.
+    if flush_change_plan(coalesce=COALESCE_WRITES):
+        if event_state == 'create':
+            undo_superseded_records(asset_id, records)
+        return
+    update_record_index([], stale_records)
+
+    # Record that the event has been applied.  A destroyed asset's attributes are removed from DynamoDB, and a create
+    # event that a destroy event overtook while its changes were submitted deletes its records again.
+    if not finish_event(event, table, records_hash) and event_state == 'create':
+        undo_superseded_records(asset_id, records)
+
+@instrumented
+def batch_handler(event, context):
+    """Updates DNS for an SQS or Kinesis batch of the CloudWatch events handled by lambda_handler.  Events for the same
+    asset are collapsed into the latest one, instances are described and DynamoDB items fetched in bulk, each asset's
+    item is claimed and finished as lambda_handler does, and the DNS changes of the whole batch are submitted as one
+    change plan.  Returns the records that failed as partial batch failures so that only those are retried."""
+    global table, change_plan, invocation_deadline, event_claims
+    change_plan = {}
+    event_claims = {}
+    invocation_deadline = get_invocation_deadline(context)
+    table = get_table('DDNS')
+
+    failures = []
+    batch = collapse_batch_records(event['Records'], failures)
+    prefetch_batch_assets(map(lambda x: x['event'], batch), table, context)
+
+    vpc_ids = {}
+    indexed_records = []
+    for record in batch:
+        record_asset_id = get_event_asset_id(record['event'])
+        try:
+            # Claim the asset's item for the event the same way lambda_handler does, so that an older event that is
+            # still being handled elsewhere can't undo it
+            stored_item = begin_event(record['event'], table, batch_prefetch['items'].pop(record_asset_id, None))
+            if stored_item is None:
+                continue
+            if get_event_state(record['event']) == 'destroy':
+                if 'AssetAttributes' not in stored_item:
+                    print 'No attributes stored for %s; nothing to delete' % record_asset_id
+                    finish_event(record['event'], table)
+                    continue
+                # Delete exactly the records that were applied for a destroyed asset if they are indexed
+                records = get_asset_records(record_asset_id)
+                if records:
+                    plan_record_deletes(records)
+                    indexed_records.extend(records)
+                    record['asset_id'] = record_asset_id
+                    continue
+                batch_prefetch['items'][record_asset_id] = stored_item
+            try:
+                processed = process_event(record['event'], context)
+            except SystemExit:
+                # process_event stops at a VPC without a DHCP option set once the records of the asset's tags are
+                # planned, as lambda_handler does, so the planned records are kept and the record hasn't failed
+                processed = True
+            if processed:
+                record['asset_id'] = asset_id
+                if event_state == 'create':
+                    vpc_ids[asset_id] = asset['extras']['vpc_id']
+        except BaseException as e:
+            print >>sys.stderr, 'Failed to process record(s) %s\n' % ', '.join(record['identifiers']), e
+            failures.extend(record['identifiers'])
+    batch_prefetch['descriptions'] = {}
+    batch_prefetch['items'] = {}
+
+    # Submit the planned A, PTR and CNAME changes to Route 53 and fail the records whose changes were rejected.  The
+    # records of created assets are indexed before they are submitted, and those of destroyed ones removed after.
+    planned_records = get_planned_records(vpc_ids)
+    update_record_index(planned_records)
+    records_hashes = dict(map(lambda x: (x, get_change_plan_hash(change_plan, x)), vpc_ids))
+    failed_asset_ids = flush_change_plan()
+    update_record_index([], filter(lambda x: x['AssetId'] not in failed_asset_ids, indexed_records))
+
+    # Record that the events have been applied.  The items of destroyed assets become tombstones, and the records of
+    # created assets that a destroy event overtook are deleted again.
+    for record in filter(lambda x: 'asset_id' in x, batch):
+        try:
+            if record['asset_id'] in failed_asset_ids:
+                failures.extend(record['identifiers'])
+            if ((record['asset_id'] in failed_asset_ids or
+                    not finish_event(record['event'], table, records_hashes.get(record['asset_id']))) and
+                    record['asset_id'] in vpc_ids):
+                undo_superseded_records(record['asset_id'], filter(lambda x: x['AssetId'] == record['asset_id'], planned_records))
+        except BaseException as e:
+            print >>sys.stderr, 'Failed to record that record(s) %s have been applied\n' % ', '.join(record['identifiers']), e
+            failures.extend(record['identifiers'])
+
+    print 'Processed %d record(s), %d failed' % (len(event['Records']), len(failures))
+    return {'batchItemFailures': map(lambda x: {'itemIdentifier': x}, failures)}
+
+@instrumented
+def reconcile_handler(event, context):
+    """Brings the DNS records of every running instance and load balancer in the region in line with their tags, the
+    DHCP option sets and the reverse lookup zones, e.g. when it's run on a schedule.  The records are planned with the
+    same rules as lambda_handler, compared with the records in each zone as they are listed, and only the differences
+    are submitted.  Unwanted records that the record index says this function wrote for the account and region are
+    deleted, unless the records of an asset couldn't be planned.  Set 'dry_run' in the event to only print the
+    differences and the zones that would be created or associated with a VPC, and 'zone_ids' to the ids of zones to
+    check even when no asset wants records in them."""
+    global table, change_plan, invocation_deadline, client_target
+    change_plan = {}
+    invocation_deadline = get_invocation_deadline(context)
+    table = get_table('DDNS')
+    reconcile_region = event.get('region') or get_aws_session().region_name
+    dry_run = event.get('dry_run', False)
+    reconcile_target = get_client_target(event.get('account'), reconcile_region, context)
+    client_target = reconcile_target
+
+    planned_assets = 0
+    failed_asset_ids = []
+    for asset_event in iter_reconcile_events(reconcile_region, event.get('account')):
+        planned_assets += 1
+        try:
+            process_event(asset_event, context, store_asset=False, plan_only=dry_run)
+        except SystemExit:
+            # lambda_handler would stop here as well, so the records planned so far are the ones it would create
+            pass
+        except BaseException as e:
+            print >>sys.stderr, 'Could not plan the records of asset %s\n' % get_event_asset_id(asset_event), e
+            failed_asset_ids.append(get_event_asset_id(asset_event))
+    batch_prefetch['descriptions'] = {}
+
+    # The change plan now holds an UPSERT of every wanted record.  Compare it with each zone instead of submitting it.
+    wanted_plan = change_plan
+    change_plan = {}
+    for zone_id in event.get('zone_ids', []):
+        wanted_plan.setdefault(short_zone_id(zone_id), {'changes': [], 'owners': {}, 'target': reconcile_target})
+    totals = {'unchanged': 0, 'upserts': 0, 'deletes': 0, 'failed': 0}
+    for zone_id, zone_plan in wanted_plan.items():
+        client_target = zone_plan['target']
+        # Only records that the index says were written for this account and region are deleted
+        indexed_records = None
+        if not failed_asset_ids:
+            try:
+                indexed_records = get_reconcile_records(zone_id, reconcile_target)
+            except ClientError as e:
+                print >>sys.stderr, 'Could not query the indexed records of zone %s; not deleting unwanted records\n' % zone_id, e
+        counts = reconcile_zone(zone_id, zone_plan['changes'], indexed_records, dry_run)
+        for key in totals:
+            totals[key] += counts[key]
+
+    print 'Reconciled %d asset(s) in %d zone(s): %d unchanged, %d upserted, %d deleted, %d failed%s' % (planned_assets,
+        len(wanted_plan), totals['unchanged'], totals['upserts'], totals['deletes'], totals['failed'], ' (dry run)' if dry_run else '')
+    if failed_asset_ids:
+        print 'Did not delete unwanted records because the records of %d asset(s) could not be planned' % len(failed_asset_ids)
+    totals['assets'] = planned_assets
+    totals['failed_asset_ids'] = failed_asset_ids
+    return totals
+
+@instrumented
+def records_handler(event, context):
+    """Lists the records that this function has applied in the hosted zone with the id 'zone_id' in the event, or for
+    the assets in the VPC with the id 'vpc_id', from the record index instead of reading the zone.  Set 'purge' to
+    true to also delete them from Route 53 and the index, and from the records hash of each asset so that its next
+    create event applies them again, and 'dry_run' to only print what would be deleted."""
+    global table, change_plan, invocation_deadline
+    change_plan = {}
+    invocation_deadline = get_invocation_deadline(context)
+    table = get_table('DDNS')
+    if event.get('zone_id'):
+        records = list(query_records(IndexName=RECORD_ZONE_INDEX, KeyConditionExpression='ZoneId = :zone_id',
+                                     ExpressionAttributeValues={':zone_id': short_zone_id(event['zone_id'])}))
+    elif event.get('vpc_id'):
+        records = list(query_records(IndexName=RECORD_VPC_INDEX, KeyConditionExpression='VpcId = :vpc_id',
+                                     ExpressionAttributeValues={':vpc_id': event['vpc_id']}))
+    else:
+        raise ValueError('Set zone_id or vpc_id in the event')
+    for record in records:
+        print '%s record %s %s in zone %s for %s' % (record['RecordType'], record['RecordName'], record['RecordValue'],
+                                                    record['ZoneId'], record['AssetId'])
+
+    result = {'records': records, 'deleted': 0, 'failed_asset_ids': []}
+    if event.get('purge') and event.get('dry_run'):
+        print 'Would delete %d record(s) (dry run)' % len(records)
+    elif event.get('purge'):
+        failed_asset_ids = delete_records(records)
+        forget_records_hashes(set(map(lambda x: x['AssetId'], records)) - failed_asset_ids)
+        result['deleted'] = len(filter(lambda x: x['AssetId'] not in failed_asset_ids, records))
+        result['failed_asset_ids'] = sorted(failed_asset_ids)
+        print 'Deleted %d record(s), the records of %d asset(s) failed' % (result['deleted'], len(failed_asset_ids))
+    return result
+
+def process_event(event, context, store_asset=True, plan_only=False):
+    """Sets the asset variables for the event and adds the DNS changes for the asset to the change plan.  Returns False
+    if the event comes from an unexpected source.  Set store_asset to False to not store a new asset in DynamoDB, and
+    plan_only to True to only print the hosted zones that would be created or associated with the VPC."""
+    global asset_id, asset, event_state, region, client_target
     asset_id = ''
     event_state = ''
     asset = {}
     region = ''
-    
-    tables = dynamodb_client.list_tables()
-    if 'DDNS' in tables['TableNames']:
-        print 'DynamoDB table already exists'
-    else:
-        create_table('DDNS')
-
-    # Set variables
-    table = dynamodb_resource.Table('DDNS')
+    client_target = get_client_target(event.get('account'), event.get('region') or event['detail'].get('awsRegion'),
+                                      context)
 
     # Check actual event type
     # And get the asset id, region, and tag collection
     if event['source'] == 'aws.ec2':
-      set_instance_vars(event)
+      set_instance_vars(event, context)
     elif event['source'] == 'aws.elasticloadbalancing':
-      try:
-        set_lbv1_vars(event)
-      except:
-        set_lbv2_vars(event)
+      if get_load_balancer_version(event) == 'v2':
+        set_lbv2_vars(event, context)
+      else:
+        set_lbv1_vars(event, context)
     else:
       print 'Unexpected event source %s' % event['source']
-      return
+      return False
+    region = asset['extras']['region']
+
+    # Store the asset and look up the VPC and subnet details and the zones associated with the VPC all at the same
+    # time.  The lookups are cached, so the code below gets their results without calling AWS.
+    lookups = {
+        'vpc_metadata': lambda: get_vpc_metadata(asset['extras']['vpc_id']),
+        'vpc_hosted_zones': lambda: get_vpc_hosted_zones(asset['extras']['vpc_id'], region)
+    }
+    if asset['extras']['type'] == 'instance' and get_cached_subnet_reverse_zones(asset['extras']['subnet_id']) is None:
+        lookups['subnet_metadata'] = lambda: get_subnet_metadata(asset['extras']['subnet_id'])
+    if event_state == 'create' and store_asset:
+        lookups['db_put_asset'] = lambda: db_put_asset(asset_id, asset, table)
+    run_concurrently(lookups)
 
     if asset['extras']['type'] == 'instance':
       # Asset is instance, thus has private IP. Get instance attributes
@@ -56,24 +716,9 @@ def lambda_handler(event, context):
       except BaseException as e:
           print 'Instance has no public IP', e
 
-      # Get the subnet mask of the instance
-      subnet = ec2.Subnet(asset['extras']['subnet_id'])
-      cidr_block = subnet.cidr_block
-      subnet_mask = int(cidr_block.split('/')[-1])
-
-      reversed_ip_address = reverse_list(private_ip)
-      reversed_domain_prefix = get_reversed_domain_prefix(subnet_mask, private_ip)
-      reversed_domain_prefix = reverse_list(reversed_domain_prefix)
-
-      # Set the reverse lookup zone for instances only
-      reversed_lookup_zone = reversed_domain_prefix + 'in-addr.arpa.'
-      print 'The reverse lookup zone for this instance is:', reversed_lookup_zone
-    else:
-      reversed_lookup_zone = ''
-
     # Get VPC id
     vpc_id = asset['extras']['vpc_id']
-    vpc = ec2.Vpc(vpc_id)
+    vpc_metadata = get_vpc_metadata(vpc_id)
     # Get private and public DNS names
     private_host_name = ''
     public_host_name = ''
@@ -89,92 +734,80 @@ def lambda_handler(event, context):
         print 'Asset '+str(asset['extras']['type'])+' has no public DNS host name', e
     
     # Are DNS Hostnames and DNS Support enabled?
-    if is_dns_hostnames_enabled(vpc):
+    if vpc_metadata['dns_hostnames']:
         print 'DNS hostnames enabled for %s' % vpc_id
     else:
         print 'DNS hostnames disabled for %s.  You have to enable DNS hostnames to use Route 53 private hosted zones.' % vpc_id
-    if is_dns_support_enabled(vpc):
+    if vpc_metadata['dns_support']:
         print 'DNS support enabled for %s' % vpc_id
     else:
         print 'DNS support disabled for %s.  You have to enabled DNS support to use Route 53 private hosted zones.' % vpc_id
 
-    # Create the public and private hosted zone collections.  These are collections of zones in Route 53.
-    hosted_zones = route53.list_hosted_zones()
-    private_hosted_zones = filter(lambda x: x['Config']['PrivateZone'] is True, hosted_zones['HostedZones'])
-    private_hosted_zones_collection = map(lambda x: {'Name': x['Name'], 'Id': str.split(str(x['Id']),'/')[2]}, private_hosted_zones)
-    public_hosted_zones = filter(lambda x: x['Config']['PrivateZone'] is False, hosted_zones['HostedZones'])
-    public_hosted_zones_collection = map(lambda x: {'Name': x['Name'], 'Id': str.split(str(x['Id']),'/')[2]}, public_hosted_zones)
-    # Check to see whether a reverse lookup zone for the instance already exists.  If it does, check to see whether
-    # the reverse lookup zone is associated with the instance's VPC.  If it isn't create the association.  You don't
-    # need to do this when you create the reverse lookup zone because the association is done automatically.
-    if filter(lambda record: record['Name'] == reversed_lookup_zone, hosted_zones['HostedZones']):
-        print 'Reverse lookup zone found:', reversed_lookup_zone
-        reverse_lookup_zone_id = get_zone_id(reversed_lookup_zone)
-        reverse_hosted_zone_properties = get_hosted_zone_properties(reverse_lookup_zone_id)
-        if vpc_id in map(lambda x: x['VPCId'], reverse_hosted_zone_properties['VPCs']):
-            print 'Reverse lookup zone %s is associated with VPC %s' % (reverse_lookup_zone_id, vpc_id)
-        else:
-            print 'Associating zone %s with VPC %s' % (reverse_lookup_zone_id, vpc_id)
-            try:
-                associate_zone(reverse_lookup_zone_id, region, vpc_id)
-            except BaseException as e:
-                print e
-    else:
-        print 'No matching reverse lookup zone'
-        # create private hosted zone for reverse lookups if it is needed
-        if event_state == 'create' and reversed_lookup_zone != '':
-            create_reverse_lookup_zone(vpc_id, reversed_domain_prefix, region)
-            reverse_lookup_zone_id = get_zone_id(reversed_lookup_zone)
-    # Wait a random amount of time.  This is a poor-mans back-off if a lot of instances are launched all at once.
-    time.sleep(random.random())
+    # Get the private hosted zones that are already associated with the VPC.
+    vpc_hosted_zones = get_vpc_hosted_zones(vpc_id, region)
+    # Get the reverse lookup zones of the instance's subnet and the PTR records of the instance's IPv4 address and, if
+    # it has one, its IPv6 address in them.
+    ptr_records = []
+    if asset['extras']['type'] == 'instance':
+        reverse_lookup_zones = get_subnet_reverse_zones(asset['extras']['subnet_id'], vpc_id, region, event_state == 'create',
+                                                        plan_only)
+        for ip_address in filter(None, [private_ip, asset['extras'].get('ipv6_address')]):
+            ptr_name = get_ptr_name(ip_address)
+            zone = reverse_lookup_zones.get(get_reverse_domain(ip_address))
+            if zone and normalize_zone_name(ptr_name).endswith('.' + normalize_zone_name(zone['Name'])):
+                ptr_records.append((zone, get_relative_name(ptr_name, zone['Name'])))
+            else:
+                print 'No reverse lookup zone for %s' % ip_address
 
     # Loop through the instance's tags, looking for the zone and cname tags.  If either of these tags exist, check
     # to make sure that the name is valid.  If it is and if there's a matching zone in DNS, create A and PTR records.
     for tag in asset['tags']:
         if 'ZONE' in tag.get('Key',{}).lstrip().upper():
             if is_valid_hostname(tag.get('Value')):
-                private_zone_record = next(( zone for zone in private_hosted_zones_collection if zone['Name'].lstrip().lower() == tag.get('Value').lstrip().lower()), False)
-                public_zone_record = next(( zone for zone in public_hosted_zones_collection if zone['Name'].lstrip().lower() == tag.get('Value').lstrip().lower()), False)
+                private_zone_record = find_zone(tag.get('Value'), private=True)
+                public_zone_record = find_zone(tag.get('Value'), private=False)
                 if private_zone_record and private_host_name != '':
                     print 'Private zone found:', tag.get('Value')
-                    private_hosted_zone_properties = get_hosted_zone_properties(private_zone_record['Id'])
                     if event_state == 'create':
-                        if vpc_id in map(lambda x: x['VPCId'], private_hosted_zone_properties['VPCs']):
+                        if is_zone_associated(private_zone_record['Id'], vpc_id, region):
                             print 'Private hosted zone %s is associated with VPC %s' % (private_zone_record['Id'], vpc_id)
+                        elif plan_only:
+                            print 'Would associate zone %s with VPC %s' % (private_zone_record['Id'], vpc_id)
                         else:
                             print 'Associating zone %s with VPC %s' % (private_zone_record['Id'], vpc_id)
                             try:
                                 associate_zone(private_zone_record['Id'], region, vpc_id)
+                                record_zone_association(private_zone_record, vpc_id, region)
                             except BaseException as e:
-                                print 'You cannot create an association with a VPC with an overlapping subdomain.\n', e
+                                print >>sys.stderr, 'You cannot create an association with a VPC with an overlapping subdomain.\n', e
                                 sys.exit()
                         try:
                             create_resource_record(private_zone_record['Id'], private_host_name, private_zone_record['Name'], 'A', private_ip)
-                            create_resource_record(reverse_lookup_zone_id, reversed_ip_address, 'in-addr.arpa', 'PTR', private_dns_name)
+                            for zone, ptr_host_name in ptr_records:
+                                create_resource_record(zone['Id'], ptr_host_name, zone['Name'], 'PTR', private_dns_name)
                         except BaseException as e:
-                            print e
+                            print >>sys.stderr, e
                     else:
                         try:
                             delete_resource_record(private_zone_record['Id'], private_host_name, private_zone_record['Name'], 'A', private_ip)
-                            delete_resource_record(reverse_lookup_zone_id, reversed_ip_address, 'in-addr.arpa', 'PTR', private_dns_name)
+                            for zone, ptr_host_name in ptr_records:
+                                delete_resource_record(zone['Id'], ptr_host_name, zone['Name'], 'PTR', private_dns_name)
                         except BaseException as e:
-                            print e
+                            print >>sys.stderr, e
                     # create PTR record
                 elif public_zone_record and public_host_name != '':
                     print 'Public zone found', tag.get('Value')
-                    public_hosted_zone_name = tag.get('Value').lstrip().lower()
-                    public_hosted_zone_id = get_zone_id(public_hosted_zone_name)
                     # create A record in public zone
                     if event_state =='create':
                         try:
                             create_resource_record(public_zone_record['Id'], public_host_name, public_zone_record['Name'], 'A', public_ip)
                         except BaseException as e:
-                            print e
+                            print >>sys.stderr, e
                     else:
                         try:
                             delete_resource_record(public_zone_record['Id'], public_host_name, public_zone_record['Name'], 'A', public_ip)
                         except BaseException as e:
-                            print e
+                            print >>sys.stderr, e
                 else:
                     print 'No matching zone found for %s' % tag.get('Value')
             else:
@@ -185,90 +818,122 @@ def lambda_handler(event, context):
         if 'CNAME' in tag.get('Key',{}).lstrip().upper():
             if is_valid_hostname(tag.get('Value')):
                 cname = tag.get('Value').lstrip().lower()
-                cname_host_name = cname.split('.')[0]
-                cname_domain_suffix = cname[cname.find('.')+1:]
-                if cname_domain_suffix[-1] != '.':
-                  cname_domain_suffix = cname_domain_suffix + '.'
-                cname_private_zone_record = next(( zone for zone in private_hosted_zones_collection if zone['Name'].lstrip().lower() == cname_domain_suffix), False)
-                cname_public_zone_record = next(( zone for zone in public_hosted_zones_collection if cname.endswith(zone['Name'])), False)
+                cname_private_zone_record = find_zone_for_name(cname, private=True)
+                # Only fully qualified names, i.e. names with a trailing dot, are matched with public zones
+                cname_public_zone_record = None
+                if cname[-1] == '.':
+                    cname_public_zone_record = find_zone_for_name(cname, private=False)
                 if cname_private_zone_record:
+                    cname_host_name = get_relative_name(cname, cname_private_zone_record['Name'])
                     #create CNAME record in private zone
                     if event_state == 'create':
                         try:
                             create_resource_record(cname_private_zone_record['Id'], cname_host_name, cname_private_zone_record['Name'], 'CNAME', private_dns_name)
                         except BaseException as e:
-                            print e
+                            print >>sys.stderr, e
                     else:
                         try:
                             delete_resource_record(cname_private_zone_record['Id'], cname_host_name, cname_private_zone_record['Name'], 'CNAME', private_dns_name)
                         except BaseException as e:
-                            print e
-# Next 3 lines could be dropped in favour of cname_public_zone_record 
-                for cname_public_hosted_zone in public_hosted_zones_collection:
-                    if cname.endswith(cname_public_hosted_zone['Name']):
-                        cname_public_hosted_zone_id = cname_public_hosted_zone['Id']
-                        #create CNAME record in public zone
-                        if event_state == 'create':
-                            try:
-                                create_resource_record(cname_public_hosted_zone_id, cname_host_name, cname_public_hosted_zone['Name'], 'CNAME', public_dns_name)
-                            except BaseException as e:
-                                print e
-                        else:
-                            try:
-                                delete_resource_record(cname_public_hosted_zone_id, cname_host_name, cname_public_hosted_zone['Name'], 'CNAME', public_dns_name)
-                            except BaseException as e:
-                                print e
+                            print >>sys.stderr, e
+                if cname_public_zone_record:
+                    cname_host_name = get_relative_name(cname, cname_public_zone_record['Name'])
+                    #create CNAME record in public zone
+                    if event_state == 'create':
+                        try:
+                            create_resource_record(cname_public_zone_record['Id'], cname_host_name, cname_public_zone_record['Name'], 'CNAME', public_dns_name)
+                        except BaseException as e:
+                            print >>sys.stderr, e
+                    else:
+                        try:
+                            delete_resource_record(cname_public_zone_record['Id'], cname_host_name, cname_public_zone_record['Name'], 'CNAME', public_dns_name)
+                        except BaseException as e:
+                            print >>sys.stderr, e
     # Is there a DHCP option set?
     # Get DHCP option set configuration
-    try:
-        dhcp_options_id = vpc.dhcp_options_id
-        dhcp_configurations = get_dhcp_configurations(dhcp_options_id)
-    except BaseException as e:
-        print 'No DHCP option set assigned to this VPC\n', e
+    dhcp_configurations = vpc_metadata['dhcp_configurations']
+    if dhcp_configurations is None:
+        print 'No DHCP option set assigned to this VPC'
         sys.exit()
     # Look to see whether there's a DHCP option set assigned to the VPC.  If there is, use the value of the domain name
     # to create resource records in the appropriate Route 53 private hosted zone. This will also check to see whether
     # there's an association between the instance's VPC and the private hosted zone.  If there isn't, it will create it.
     for configuration in dhcp_configurations:
-        private_zone_record = next(( zone for zone in private_hosted_zones_collection if zone['Name'].lstrip().lower() == configuration[0].lstrip().lower()), False)
+        private_zone_record = vpc_hosted_zones.get(normalize_zone_name(configuration[0])) or find_zone(configuration[0], private=True)
         if private_zone_record:
             print 'Private zone found %s' % private_zone_record['Name']
             # TODO need a way to prevent overlapping subdomains
-            private_hosted_zone_properties = get_hosted_zone_properties(private_zone_record['Id'])
             # create A records and PTR records
             if event_state == 'create':
-                if vpc_id in map(lambda x: x['VPCId'], private_hosted_zone_properties['VPCs']):
+                if is_zone_associated(private_zone_record['Id'], vpc_id, region):
                     print 'Private hosted zone %s is associated with VPC %s' % (private_zone_record['Id'], vpc_id)
+                elif plan_only:
+                    print 'Would associate zone %s with VPC %s' % (private_zone_record['Id'], vpc_id)
                 else:
                     print 'Associating zone %s with VPC %s' % (private_zone_record['Id'], vpc_id)
                     try:
                         associate_zone(private_zone_record['Id'], region,vpc_id)
+                        record_zone_association(private_zone_record, vpc_id, region)
                     except BaseException as e:
-                        print 'You cannot create an association with a VPC with an overlapping subdomain.\n', e
+                        print >>sys.stderr, 'You cannot create an association with a VPC with an overlapping subdomain.\n', e
                         sys.exit()
                 try:
                     create_resource_record(private_zone_record['Id'], private_host_name, private_zone_record['Name'], 'A', private_ip)
-                    create_resource_record(reverse_lookup_zone_id, reversed_ip_address, 'in-addr.arpa', 'PTR', private_dns_name)
+                    for zone, ptr_host_name in ptr_records:
+                        create_resource_record(zone['Id'], ptr_host_name, zone['Name'], 'PTR', private_dns_name)
                 except BaseException as e:
-                    print e
+                    print >>sys.stderr, e
             else:
                 try:
                     delete_resource_record(private_zone_record['Id'], private_host_name, private_zone_record['Name'], 'A', private_ip)
-                    delete_resource_record(reverse_lookup_zone_id, reversed_ip_address, 'in-addr.arpa', 'PTR', private_dns_name)
+                    for zone, ptr_host_name in ptr_records:
+                        delete_resource_record(zone['Id'], ptr_host_name, zone['Name'], 'PTR', private_dns_name)
                 except BaseException as e:
-                    print e
+                    print >>sys.stderr, e
         else:
             print 'No matching zone for %s' % configuration[0]
-            
-    # Clean up DynamoDB after deleting records
-    if event_state != 'create':
-        table.delete_item(
-            Key={
-                'AssetId': asset_id
-            }
-        )
-        
+    return True
+
+def get_table(table_name, create=None):
+    """ Check to see whether a DynamoDB table already exists.  If not, create it.  This table is used to keep a record of
+    assets that have been created along with their attributes.  This is necessary because when you terminate it
+    its attributes are no longer available, so they have to be fetched from the table.  Other tables are created with
+    the create function instead."""
+    table = dynamodb_resource.Table(table_name)
+    if table_name in known_tables:
+        return table
+    try:
+        table_description = dynamodb_client.describe_table(TableName=table_name)
+        print 'DynamoDB table %s already exists' % table_name
+        if table_description['Table']['TableStatus'] == 'CREATING':
+            table.wait_until_exists()
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        (create or create_table)(table_name)
+    known_tables.add(table_name)
+    return table
+
+def forget_table(e, table):
+    """Makes the next get_table call check the table again if the error says that it doesn't exist."""
+    if isinstance(e, ClientError) and e.response['Error']['Code'] == 'ResourceNotFoundException':
+        known_tables.discard(table.name)
+        return True
+    return False
+
+def get_table_capacity():
+    """Returns the billing mode or the provisioned throughput of a new table."""
+    if TABLE_BILLING_MODE == 'PAY_PER_REQUEST':
+        return {'BillingMode': 'PAY_PER_REQUEST'}
+    return {
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': 4,
+            'WriteCapacityUnits': 4
+        }
+    }
+
 def create_table(table_name):
+    capacity = get_table_capacity()
     dynamodb_client.create_table(
             TableName=table_name,
             AttributeDefinitions=[
@@ -283,25 +948,59 @@ def create_table(table_name):
                     'KeyType': 'HASH'
                 },
             ],
-            ProvisionedThroughput={
-                'ReadCapacityUnits': 4,
-                'WriteCapacityUnits': 4
-            }
+            **capacity
         )
     table = dynamodb_resource.Table(table_name)
     table.wait_until_exists()
+    # Let DynamoDB remove the tombstones and shared cache entries once they have expired
+    dynamodb_client.update_time_to_live(
+            TableName=table_name,
+            TimeToLiveSpecification={
+                'Enabled': True,
+                'AttributeName': 'ExpiresAt'
+            }
+        )
+
+def create_record_table(table_name):
+    """Creates the record index table, keyed by asset id and record key, with its ZoneId and VpcId indexes."""
+    capacity = get_table_capacity()
+    index_capacity = dict(filter(lambda x: x[0] == 'ProvisionedThroughput', capacity.items()))
+    dynamodb_client.create_table(
+            TableName=table_name,
+            AttributeDefinitions=[
+                {'AttributeName': 'AssetId', 'AttributeType': 'S'},
+                {'AttributeName': 'RecordKey', 'AttributeType': 'S'},
+                {'AttributeName': 'ZoneId', 'AttributeType': 'S'},
+                {'AttributeName': 'VpcId', 'AttributeType': 'S'}
+            ],
+            KeySchema=[
+                {'AttributeName': 'AssetId', 'KeyType': 'HASH'},
+                {'AttributeName': 'RecordKey', 'KeyType': 'RANGE'}
+            ],
+            GlobalSecondaryIndexes=map(lambda x: dict({
+                'IndexName': x,
+                'KeySchema': [
+                    {'AttributeName': x, 'KeyType': 'HASH'},
+                    {'AttributeName': 'RecordKey', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'}
+            }, **index_capacity), [RECORD_ZONE_INDEX, RECORD_VPC_INDEX]),
+            **capacity
+        )
+    dynamodb_resource.Table(table_name).wait_until_exists()
 
-def set_instance_vars(event):
+def set_instance_vars(event, context):
   global asset_id, asset, event_state
 
   asset_id = event['detail']['instance-id'] 
 
   if event['detail']['state'] == 'running':
-    time.sleep(60)
     event_state = 'create'
-    asset = compute.describe_instances(InstanceIds=[asset_id])
+    asset = batch_prefetch['descriptions'].pop(asset_id, None)
+    if asset is None or not is_instance_ready(asset):
+      asset = wait_for_asset(lambda: compute.describe_instances(InstanceIds=[asset_id]), is_instance_ready, context)
     # Remove response metadata from the response
-    asset.pop('ResponseMetadata')
+    asset.pop('ResponseMetadata', None)
     try:
       tags = asset['Reservations'][0]['Instances'][0]['Tags']
     except:
@@ -319,28 +1018,36 @@ def set_instance_vars(event):
       print 'Instance has no public IP or host name', e
     asset['extras']['subnet_id'] = asset['Reservations'][0]['Instances'][0]['SubnetId']
     asset['extras']['vpc_id'] = asset['Reservations'][0]['Instances'][0]['VpcId']
-    db_put_asset(asset_id, asset, table)
+    # Use the first IPv6 address of the primary network interface, if the instance has one
+    try:
+      network_interface = filter(lambda x: x['Attachment']['DeviceIndex'] == 0, asset['Reservations'][0]['Instances'][0]['NetworkInterfaces'])[0]
+      asset['extras']['ipv6_address'] = network_interface['Ipv6Addresses'][0]['Ipv6Address']
+    except (KeyError, IndexError):
+      pass
   else:
     event_state = 'destroy'
     # Fetch item from DynamoDB
     asset = db_fetch_asset(asset_id, table)
 
-def set_lbv1_vars(event):
+def set_lbv1_vars(event, context):
   global asset_id, asset, event_state
 
   asset_id = event['detail']['requestParameters']['loadBalancerName']
   
   if event['detail']['eventName'] == 'CreateLoadBalancer':
-    time.sleep(60)
     event_state = 'create'
-    asset = elb.describe_load_balancers(LoadBalancerNames=[asset_id])
-    # Remove response metadata from the response
-    asset.pop('ResponseMetadata')
-    try:
-      tags = elb.describe_tags(LoadBalancerNames=[asset_id])['TagDescriptions'][0]['Tags']
-    except:
-      tags = []
-    asset['tags'] = tags
+    metadata = get_cached_load_balancer(asset_id)
+    if metadata is None or not is_lbv1_ready(metadata['description']):
+      description = wait_for_asset(lambda: elb.describe_load_balancers(LoadBalancerNames=[asset_id]), is_lbv1_ready, context)
+      # Remove response metadata from the response
+      description.pop('ResponseMetadata', None)
+      try:
+        tags = elb.describe_tags(LoadBalancerNames=[asset_id])['TagDescriptions'][0]['Tags']
+      except:
+        tags = []
+      metadata = cache_load_balancer(asset_id, description, tags)
+    asset = dict(metadata['description'])
+    asset['tags'] = metadata['tags']
     asset['extras'] = {}
     asset['extras']['type'] = 'elb'
     asset['extras']['version'] = 'v1'
@@ -352,27 +1059,30 @@ def set_lbv1_vars(event):
     else:
       asset['extras']['public_dns_name'] = asset['LoadBalancerDescriptions'][0]['DNSName']
     asset['extras']['vpc_id'] = asset['LoadBalancerDescriptions'][0]['VPCId']
-    db_put_asset(asset_id, asset, table)
   else:
     event_state = 'destroy'
+    load_balancer_cache.pop((client_target, asset_id), None)
     asset = db_fetch_asset(asset_id, table)
 
-def set_lbv2_vars(event):
+def set_lbv2_vars(event, context):
   global asset_id, asset, event_state
 
   if event['detail']['eventName'] == 'CreateLoadBalancer':
-    time.sleep(60)
     event_state='create'
 #    lbv2_name = event['detail']['requestParameters']['name']
 #    asset_id = elbv2.describe_load_balancers(Names=[lbv2_name])['LoadBalancers'][0]['LoadBalancerArn']
     asset_id = event['detail']['responseElements']['loadBalancers'][0]['loadBalancerArn']
-    asset = elbv2.describe_load_balancers(LoadBalancerArns=[asset_id])
-    asset.pop('ResponseMetadata')
-    try:
-      tags = elbv2.describe_tags(ResourceArns=[asset_id])['TagDescriptions'][0]['Tags']
-    except:
-      tags = []
-    asset['tags'] = tags
+    metadata = get_cached_load_balancer(asset_id)
+    if metadata is None or not is_lbv2_ready(metadata['description']):
+      description = wait_for_asset(lambda: elbv2.describe_load_balancers(LoadBalancerArns=[asset_id]), is_lbv2_ready, context)
+      description.pop('ResponseMetadata', None)
+      try:
+        tags = elbv2.describe_tags(ResourceArns=[asset_id])['TagDescriptions'][0]['Tags']
+      except:
+        tags = []
+      metadata = cache_load_balancer(asset_id, description, tags)
+    asset = dict(metadata['description'])
+    asset['tags'] = metadata['tags']
     asset['extras'] = {}
     asset['extras']['type'] = 'elb'
     asset['extras']['version'] = 'v2'
@@ -384,38 +1094,393 @@ def set_lbv2_vars(event):
     else:
       asset['extras']['public_dns_name'] = asset['LoadBalancers'][0]['DNSName']
     asset['extras']['vpc_id'] = asset['LoadBalancers'][0]['VpcId']
-    db_put_asset(asset_id, asset, table)
   else:
     event_state='destroy'
     asset_id = event['detail']['requestParameters']['loadBalancerArn']
+    load_balancer_cache.pop((client_target, asset_id), None)
     asset = db_fetch_asset(asset_id, table)
 
+def get_load_balancer_version(event):
+    """Tells from the CloudTrail event whether it is about a classic load balancer ('v1') or an application or network
+    load balancer ('v2'), without calling AWS: by the API version of the call, or else by whether the load balancer is
+    named by an ARN."""
+    detail = event['detail']
+    if detail.get('apiVersion') in ('2012-06-01', '2015-12-01'):
+        return 'v1' if detail['apiVersion'] == '2012-06-01' else 'v2'
+    if 'loadBalancerName' in (detail.get('requestParameters') or {}):
+        return 'v1'
+    return 'v2' if is_load_balancer_arn(get_event_asset_id(event)) else 'v1'
+
+def is_load_balancer_arn(load_balancer_id):
+    """Returns True if the id is the ARN of an application or network load balancer."""
+    return bool(load_balancer_id) and re.match(r'^arn:[^:]+:elasticloadbalancing:[^:]*:\d*:loadbalancer/(app|net)/', load_balancer_id) is not None
+
+def get_cached_load_balancer(load_balancer_id):
+    """Returns the cached description and tags of the load balancer, or None if they aren't cached."""
+    entry = load_balancer_cache.get((client_target, load_balancer_id))
+    if entry is None or time.time() >= entry['expires']:
+        return None
+    return entry
+
+def cache_load_balancer(load_balancer_id, description, tags):
+    """Caches the description, in the shape of a describe_load_balancers response for just this load balancer, and
+    the tags of the load balancer, and returns the cache entry."""
+    entry = {'expires': time.time() + LB_CACHE_TTL, 'description': description, 'tags': tags}
+    load_balancer_cache[(client_target, load_balancer_id)] = entry
+    return entry
+
+def prefetch_load_balancers(load_balancer_ids):
+    """Describes the load balancers that aren't cached and fetches their tags, with one describe_load_balancers and
+    one describe_tags call for up to MAX_DESCRIBE_LOAD_BALANCER_TAGS classic or v2 load balancers at a time.  Anything
+    that can't be prefetched is described again when its event is processed."""
+    load_balancer_ids = filter(lambda x: get_cached_load_balancer(x) is None, set(load_balancer_ids))
+    names = filter(lambda x: not is_load_balancer_arn(x), load_balancer_ids)
+    arns = filter(is_load_balancer_arn, load_balancer_ids)
+    for i in range(0, len(names), MAX_DESCRIBE_LOAD_BALANCER_TAGS):
+        chunk = names[i:i + MAX_DESCRIBE_LOAD_BALANCER_TAGS]
+        try:
+            descriptions = elb.describe_load_balancers(LoadBalancerNames=chunk)['LoadBalancerDescriptions']
+            tags = elb.describe_tags(LoadBalancerNames=chunk)['TagDescriptions']
+        except BaseException as e:
+            print >>sys.stderr, 'Could not describe the classic load balancers %s\n' % ', '.join(chunk), e
+            continue
+        tags = dict(map(lambda x: (x['LoadBalancerName'], x.get('Tags', [])), tags))
+        for description in descriptions:
+            cache_load_balancer(description['LoadBalancerName'], {'LoadBalancerDescriptions': [description]},
+                                tags.get(description['LoadBalancerName'], []))
+    for i in range(0, len(arns), MAX_DESCRIBE_LOAD_BALANCER_TAGS):
+        chunk = arns[i:i + MAX_DESCRIBE_LOAD_BALANCER_TAGS]
+        try:
+            descriptions = elbv2.describe_load_balancers(LoadBalancerArns=chunk)['LoadBalancers']
+            tags = elbv2.describe_tags(ResourceArns=chunk)['TagDescriptions']
+        except BaseException as e:
+            print >>sys.stderr, 'Could not describe the load balancers %s\n' % ', '.join(chunk), e
+            continue
+        tags = dict(map(lambda x: (x['ResourceArn'], x.get('Tags', [])), tags))
+        for description in descriptions:
+            cache_load_balancer(description['LoadBalancerArn'], {'LoadBalancers': [description]},
+                                tags.get(description['LoadBalancerArn'], []))
+
+def parse_batch_record(record):
+    """Returns the CloudWatch event carried by an SQS or Kinesis record and the identifier used to report the record
+    as a partial batch failure."""
+    if record.get('eventSource') == 'aws:kinesis':
+        return json.loads(base64.b64decode(record['kinesis']['data'])), record['kinesis']['sequenceNumber']
+    return json.loads(record['body']), record['messageId']
+
+def get_event_asset_id(event):
+    """Returns the id of the instance or load balancer that the event is about, or None if it can't be told."""
+    try:
+        if event['source'] == 'aws.ec2':
+            return event['detail']['instance-id']
+        detail = event['detail']
+        if 'loadBalancerName' in detail['requestParameters']:
+            return detail['requestParameters']['loadBalancerName']
+        if 'loadBalancerArn' in detail['requestParameters']:
+            return detail['requestParameters']['loadBalancerArn']
+        return detail['responseElements']['loadBalancers'][0]['loadBalancerArn']
+    except (KeyError, IndexError, TypeError):
+        return None
+
+def get_event_state(event):
+    """Returns whether the event creates or destroys the asset's records, without describing the asset."""
+    if event['source'] == 'aws.ec2':
+        return 'create' if event['detail']['state'] == 'running' else 'destroy'
+    return 'create' if event['detail']['eventName'] == 'CreateLoadBalancer' else 'destroy'
+
+def collapse_batch_records(records, failures):
+    """Parses the batch records and keeps only the latest event for each asset, since it supersedes the earlier
+    state transitions of the asset.  Returns a list of {'event', 'identifiers'} dicts in batch order, where identifiers
+    are the records represented by the event.  Identifiers of records that can't be parsed are added to failures."""
+    latest = {}
+    for position, record in enumerate(records):
+        try:
+            event, identifier = parse_batch_record(record)
+        except BaseException as e:
+            identifier = record.get('messageId') or record.get('kinesis', {}).get('sequenceNumber')
+            print >>sys.stderr, 'Could not parse record %s\n' % identifier, e
+            failures.append(identifier)
+            continue
+        key = get_event_asset_id(event) or identifier
+        order = (event.get('time', ''), position)
+        if key in latest:
+            previous = latest[key]
+            identifiers = previous['identifiers'] + [identifier]
+            if order < previous['order']:
+                event, order = previous['event'], previous['order']
+            print 'Collapsed %d events for asset %s' % (len(identifiers), key)
+        else:
+            identifiers = [identifier]
+        latest[key] = {'event': event, 'order': order, 'identifiers': identifiers}
+    return sorted(latest.values(), key=lambda x: x['order'])
+
+def prefetch_batch_assets(events, table, context=None):
+    """Describes the instances of the running events with as few describe_instances calls as possible, the load
+    balancers of the CreateLoadBalancer events with prefetch_load_balancers, and fetches the DynamoDB items of all the
+    events with BatchGetItem.  Instances and load balancers are described per account and region.  Anything that can't
+    be prefetched is fetched again when its event is processed."""
+    global client_target
+    instance_ids = {}
+    load_balancer_ids = {}
+    item_asset_ids = []
+    for event in events:
+        event_asset_id = get_event_asset_id(event)
+        if event_asset_id is None:
+            continue
+        item_asset_ids.append(event_asset_id)
+        target = get_client_target(event.get('account'), event.get('region') or event['detail'].get('awsRegion'), context)
+        if event['source'] == 'aws.ec2' and event['detail'].get('state') == 'running':
+            instance_ids.setdefault(target, []).append(event_asset_id)
+        elif event['detail'].get('eventName') == 'CreateLoadBalancer':
+            load_balancer_ids.setdefault(target, []).append(event_asset_id)
+    for client_target in load_balancer_ids:
+        prefetch_load_balancers(load_balancer_ids[client_target])
+
+    for client_target in instance_ids:
+        target_instance_ids = instance_ids[client_target]
+        for i in range(0, len(target_instance_ids), MAX_DESCRIBE_INSTANCE_IDS):
+            try:
+                reservations = compute.describe_instances(InstanceIds=target_instance_ids[i:i + MAX_DESCRIBE_INSTANCE_IDS])['Reservations']
+            except BaseException as e:
+                print >>sys.stderr, 'Could not describe the instances of the batch\n', e
+                continue
+            for reservation in reservations:
+                for instance in reservation['Instances']:
+                    single_reservation = dict(reservation)
+                    single_reservation['Instances'] = [instance]
+                    batch_prefetch['descriptions'][instance['InstanceId']] = {'Reservations': [single_reservation]}
+    client_target = None
+
+    # The items are read consistently so that begin_event can claim them without reading them again.  An asset
+    # without an item is prefetched as an empty one.
+    for i in range(0, len(item_asset_ids), MAX_BATCH_GET_KEYS):
+        pending_asset_ids = set(item_asset_ids[i:i + MAX_BATCH_GET_KEYS])
+        request_items = {
+            table.name: {
+                'Keys': map(lambda x: {'AssetId': x}, pending_asset_ids),
+                'ConsistentRead': True
+            }
+        }
+        try:
+            while request_items:
+                response = dynamodb_resource.batch_get_item(RequestItems=request_items)
+                for item in response['Responses'].get(table.name, []):
+                    batch_prefetch['items'][item['AssetId']] = item
+                request_items = response.get('UnprocessedKeys')
+                unprocessed_asset_ids = set(map(lambda x: x['AssetId'], (request_items or {}).get(table.name, {}).get('Keys', [])))
+                for item_asset_id in pending_asset_ids - unprocessed_asset_ids:
+                    batch_prefetch['items'].setdefault(item_asset_id, {})
+                pending_asset_ids = unprocessed_asset_ids
+        except BaseException as e:
+            print >>sys.stderr, 'Could not fetch the assets of the batch from DynamoDB\n', e
+
+def iter_reconcile_events(region, account_id=None):
+    """Yields a create event for every running instance and every load balancer in a VPC, as lambda_handler would
+    receive it from the account.  Instances and load balancers are described a page at a time, and the descriptions
+    and tags of a page are prefetched so that processing its events doesn't have to describe them again."""
+    kwargs = {'Filters': [{'Name': 'instance-state-name', 'Values': ['running']}], 'MaxResults': MAX_DESCRIBE_INSTANCE_IDS}
+    while True:
+        response = compute.describe_instances(**kwargs)
+        instance_ids = []
+        for reservation in response['Reservations']:
+            for instance in reservation['Instances']:
+                single_reservation = dict(reservation)
+                single_reservation['Instances'] = [instance]
+                batch_prefetch['descriptions'][instance['InstanceId']] = {'Reservations': [single_reservation]}
+                instance_ids.append(instance['InstanceId'])
+        for instance_id in instance_ids:
+            yield {'source': 'aws.ec2', 'account': account_id, 'region': region, 'detail': {'instance-id': instance_id, 'state': 'running'}}
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+
+    kwargs = {'PageSize': MAX_DESCRIBE_LOAD_BALANCERS}
+    while True:
+        response = elb.describe_load_balancers(**kwargs)
+        descriptions = {}
+        names = []
+        for load_balancer in response['LoadBalancerDescriptions']:
+            if load_balancer.get('VPCId'):
+                descriptions[load_balancer['LoadBalancerName']] = {'LoadBalancerDescriptions': [load_balancer]}
+                names.append(load_balancer['LoadBalancerName'])
+        for i in range(0, len(names), MAX_DESCRIBE_LOAD_BALANCER_TAGS):
+            for description in elb.describe_tags(LoadBalancerNames=names[i:i + MAX_DESCRIBE_LOAD_BALANCER_TAGS])['TagDescriptions']:
+                cache_load_balancer(description['LoadBalancerName'], descriptions[description['LoadBalancerName']],
+                                    description.get('Tags', []))
+        for name in names:
+            yield {'source': 'aws.elasticloadbalancing', 'account': account_id, 'detail': {'eventName': 'CreateLoadBalancer', 'awsRegion': region,
+                   'requestParameters': {'loadBalancerName': name}}}
+        if not response.get('NextMarker'):
+            break
+        kwargs['Marker'] = response['NextMarker']
+
+    kwargs = {'PageSize': MAX_DESCRIBE_LOAD_BALANCERS}
+    while True:
+        response = elbv2.describe_load_balancers(**kwargs)
+        descriptions = {}
+        arns = []
+        for load_balancer in response['LoadBalancers']:
+            if load_balancer.get('VpcId'):
+                descriptions[load_balancer['LoadBalancerArn']] = {'LoadBalancers': [load_balancer]}
+                arns.append(load_balancer['LoadBalancerArn'])
+        for i in range(0, len(arns), MAX_DESCRIBE_LOAD_BALANCER_TAGS):
+            for description in elbv2.describe_tags(ResourceArns=arns[i:i + MAX_DESCRIBE_LOAD_BALANCER_TAGS])['TagDescriptions']:
+                cache_load_balancer(description['ResourceArn'], descriptions[description['ResourceArn']],
+                                    description.get('Tags', []))
+        for arn in arns:
+            yield {'source': 'aws.elasticloadbalancing', 'account': account_id, 'detail': {'eventName': 'CreateLoadBalancer', 'awsRegion': region,
+                   'requestParameters': {'name': arn.split('/')[-2]}, 'responseElements': {'loadBalancers': [{'loadBalancerArn': arn}]}}}
+        if not response.get('NextMarker'):
+            break
+        kwargs['Marker'] = response['NextMarker']
+
+def run_concurrently(calls):
+    """Makes the calls, a dict of names to functions without arguments, on up to FANOUT_WORKERS threads at a time and
+    waits for all of them to finish.  Returns a dict of names to results.  If any call raised an exception, the first
+    one is raised again once all the calls have finished.  Prints how long each call took, how long they took
+    together and how long they would have taken one after another."""
+    names = calls.keys()
+    outcomes = {}
+    def run(name):
+        call_start = time.time()
+        try:
+            outcomes[name] = (calls[name](), None, time.time() - call_start)
+        except BaseException as e:
+            outcomes[name] = (None, e, time.time() - call_start)
+    start = time.time()
+    if FANOUT_WORKERS > 1 and len(names) > 1:
+        for i in range(0, len(names), FANOUT_WORKERS):
+            threads = map(lambda x: threading.Thread(target=run, args=(x,)), names[i:i + FANOUT_WORKERS])
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    else:
+        for name in names:
+            run(name)
+    if names:
+        print 'Fan-out of %d call(s) took %.3fs, %.3fs one after another (%s)' % (len(names), time.time() - start,
+            sum(map(lambda x: x[2], outcomes.values())), ', '.join(map(lambda x: '%s %.3fs' % (x, outcomes[x][2]), names)))
+    for name in names:
+        if outcomes[name][1] is not None:
+            raise outcomes[name][1]
+    return dict(map(lambda x: (x, outcomes[x][0]), names))
+
+def get_ready_deadline(context):
+    """Returns the time by which the asset has to be ready, leaving enough of the invocation for the DNS work."""
+    deadline = time.time() + READY_TIMEOUT
+    if context is not None:
+        deadline = min(deadline, time.time() + context.get_remaining_time_in_millis() / 1000.0 - READY_RESERVE)
+    return deadline
+
+def wait_for_asset(describe, is_ready, context):
+    """Calls describe until is_ready returns True for its response or the deadline passes, and returns the last
+    response.  Errors saying that the asset doesn't exist yet are retried until the deadline, and the last one is
+    raised if the asset still doesn't exist then."""
+    if WAIT_MODE == 'sleep':
+        time.sleep(READY_TIMEOUT)
+        return describe()
+    deadline = get_ready_deadline(context)
+    delay = READY_POLL_BASE_DELAY
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            response = describe()
+            if is_ready(response):
+                print 'Asset ready after %d describe call(s)' % attempts
+                return response
+        except ClientError as e:
+            if e.response['Error']['Code'] not in READY_NOT_FOUND_ERRORS or time.time() >= deadline:
+                raise
+            print 'Asset not found yet', e
+            response = None
+            not_found_error = e
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            if response is None:
+                print 'Asset not found after %d describe call(s)' % attempts
+                raise not_found_error
+            print 'Asset not ready after %d describe call(s), using the last response' % attempts
+            return response
+        time.sleep(min(delay / 2 + random.uniform(0, delay / 2), remaining))
+        delay = min(delay * 2, READY_POLL_MAX_DELAY)
+
+def is_instance_ready(asset):
+    """Returns True once the instance has the IP addresses and DNS names needed for its records."""
+    try:
+        instance = asset['Reservations'][0]['Instances'][0]
+    except IndexError:
+        return False
+    if not instance.get('PrivateIpAddress') or not instance.get('PrivateDnsName'):
+        return False
+    if instance.get('PublicIpAddress') and not instance.get('PublicDnsName'):
+        # Instances only get a public DNS name when DNS hostnames are enabled for the VPC
+        return not get_vpc_metadata(instance['VpcId'])['dns_hostnames']
+    return True
+
+def is_lbv1_ready(asset):
+    """Returns True once the classic load balancer has a DNS name."""
+    try:
+        return bool(asset['LoadBalancerDescriptions'][0].get('DNSName'))
+    except IndexError:
+        return False
+
+def is_lbv2_ready(asset):
+    """Returns True once the load balancer has a DNS name and a state."""
+    try:
+        load_balancer = asset['LoadBalancers'][0]
+    except IndexError:
+        return False
+    return bool(load_balancer.get('DNSName')) and 'State' in load_balancer
+
 def db_put_asset(asset_id, asset, table):
+  # Only the tags and extras are needed to delete the asset's records, so unless the full description is asked for
+  # only those are stored
+  if ASSET_ATTRIBUTES != 'full':
+    asset = {'tags': asset['tags'], 'extras': asset['extras']}
   # Remove null values from the response.  You cannot save a dict/JSON document in DynamoDB if it contains null
   # values
-  asset = remove_empty_from_dict(asset)
-  asset_dump = json.dumps(asset,default=json_serial)
-  asset_attributes = json.loads(asset_dump)
-
-  table.put_item(
-      Item={
-          'AssetId': asset_id,
-          'AssetAttributes': asset_attributes
+  asset_attributes = remove_empty_from_dict(asset)
+
+  # Update only the attributes so that the event lambda_handler has claimed the item for is kept
+  update = {
+      'Key': {
+          'AssetId': asset_id
+      },
+      'UpdateExpression': 'SET AssetAttributes = :asset_attributes',
+      'ExpressionAttributeValues': {
+          ':asset_attributes': asset_attributes
       }
-  )
+  }
+  try:
+    table.update_item(**update)
+  except ClientError as e:
+    if not forget_table(e, table):
+      raise
+    # The table has been deleted since this container last checked it, so create it again
+    get_table(table.name).update_item(**update)
   region = asset['extras']['region']
 
 def db_fetch_asset(asset_id, table):
-  # Fetch item from DynamoDB
-  asset = table.get_item(
-  Key={
-      'AssetId': asset_id
-  },
-  AttributesToGet=[
-      'AssetAttributes'
-      ]
-  )
-  asset = asset['Item']['AssetAttributes']
+  # Use the item fetched by batch_handler if there is one
+  asset = batch_prefetch['items'].pop(asset_id, None)
+  if asset is None:
+    # Fetch item from DynamoDB
+    try:
+      asset = table.get_item(
+      Key={
+          'AssetId': asset_id
+      },
+      AttributesToGet=[
+          'AssetAttributes'
+          ]
+      )
+    except ClientError as e:
+      forget_table(e, table)
+      raise
+    asset = asset['Item']
+  asset = asset['AssetAttributes']
   # Make sure that empty elements are initialized
   try:
     tags = asset['tags']
@@ -426,71 +1491,853 @@ def db_fetch_asset(asset_id, table):
 
   return asset
 
+def get_event_key(event):
+    """Returns the id and the time of the event.  An event without them, e.g. one that was sent by hand, gets a new id
+    and the current time."""
+    return event.get('id') or str(uuid.uuid4()), event.get('time') or datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def begin_event(event, table, item=None):
+    """Claims the DynamoDB item of the event's asset for the event and returns the item as it was before.  Returns
+    None if the event has already been applied, if the asset has already been destroyed or if a newer event for the
+    asset has been claimed.  The item is read again unless it has been fetched with a consistent read already."""
+    event_asset_id = get_event_asset_id(event)
+    event_id, event_time = get_event_key(event)
+    if event_asset_id is None:
+        print 'Event %s is not about an instance or a load balancer' % event_id
+        return None
+    if item is None:
+        try:
+            item = table.get_item(Key={'AssetId': event_asset_id}, ConsistentRead=True).get('Item', {})
+        except ClientError as e:
+            forget_table(e, table)
+            raise
+    if item.get('EventId') == event_id and item.get('Applied'):
+        print 'Event %s has already been applied to %s' % (event_id, event_asset_id)
+        return None
+    if item.get('EventTime', '') > event_time:
+        print 'Event %s is older than event %s for %s' % (event_id, item['EventId'], event_asset_id)
+        return None
+    if get_event_state(event) == 'destroy' and item.get('Destroyed') and item.get('Applied'):
+        print '%s has already been destroyed' % event_asset_id
+        return None
+    update_expression = 'SET EventId = :event_id, EventTime = :event_time, EventState = :event_state, Applied = :false'
+    if get_event_state(event) == 'create':
+        update_expression += ' REMOVE ExpiresAt'
+    try:
+        table.update_item(
+            Key={
+                'AssetId': event_asset_id
+            },
+            UpdateExpression=update_expression,
+            ConditionExpression='attribute_not_exists(EventTime) OR EventTime <= :event_time',
+            ExpressionAttributeValues={
+                ':event_id': event_id,
+                ':event_time': event_time,
+                ':event_state': get_event_state(event),
+                ':false': False
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            forget_table(e, table)
+            raise
+        print 'A newer event for %s has been claimed; skipping event %s' % (event_asset_id, event_id)
+        return None
+    event_claims[event_asset_id] = event_id
+    return item
+
+def finish_event(event, table, records_hash=None):
+    """Records in the DynamoDB item of the event's asset that the event has been applied, unless a newer event has
+    been claimed since.  The item of a destroyed asset becomes a tombstone that expires after TOMBSTONE_TTL seconds.
+    Returns False if a newer event has been claimed."""
+    event_id, _ = get_event_key(event)
+    event_claims.pop(get_event_asset_id(event), None)
+    if get_event_state(event) == 'create':
+        update_expression = 'SET Applied = :true, Destroyed = :false, RecordsHash = :records_hash'
+        values = {':false': False, ':records_hash': records_hash}
+    else:
+        update_expression = 'SET Applied = :true, Destroyed = :true, ExpiresAt = :expires_at REMOVE AssetAttributes, RecordsHash'
+        values = {':expires_at': int(time.time() + TOMBSTONE_TTL)}
+    values.update({':event_id': event_id, ':true': True})
+    try:
+        table.update_item(
+            Key={
+                'AssetId': get_event_asset_id(event)
+            },
+            UpdateExpression=update_expression,
+            ConditionExpression='EventId = :event_id',
+            ExpressionAttributeValues=values
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print 'A newer event for %s has been claimed since event %s' % (get_event_asset_id(event), event_id)
+        return False
+    return True
+
+def forget_records_hashes(asset_ids):
+    """Removes the records hash from the DynamoDB items of the assets whose records have been purged, so that their
+    next create event applies their records again instead of finding them unchanged."""
+    for purged_asset_id in asset_ids:
+        try:
+            table.update_item(
+                Key={
+                    'AssetId': purged_asset_id
+                },
+                UpdateExpression='REMOVE RecordsHash',
+                ConditionExpression='attribute_exists(AssetId)'
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                print >>sys.stderr, 'Could not forget the records hash of %s\n' % purged_asset_id, e
+
+def get_lost_claims(asset_ids):
+    """Returns the assets among asset_ids that this invocation claimed for an event and that a newer event has claimed
+    since, with consistent BatchGetItem reads.  Assets whose claims can't be checked are taken to be still claimed."""
+    claimed_asset_ids = filter(lambda x: x in event_claims, asset_ids)
+    lost_asset_ids = set()
+    for i in range(0, len(claimed_asset_ids), MAX_BATCH_GET_KEYS):
+        request_items = {
+            table.name: {
+                'Keys': map(lambda x: {'AssetId': x}, claimed_asset_ids[i:i + MAX_BATCH_GET_KEYS]),
+                'ProjectionExpression': 'AssetId, EventId',
+                'ConsistentRead': True
+            }
+        }
+        try:
+            while request_items:
+                response = dynamodb_resource.batch_get_item(RequestItems=request_items)
+                for item in response['Responses'].get(table.name, []):
+                    if item.get('EventId') != event_claims[item['AssetId']]:
+                        lost_asset_ids.add(item['AssetId'])
+                request_items = response.get('UnprocessedKeys')
+        except BaseException as e:
+            print >>sys.stderr, 'Could not check the claims of the assets\n', e
+    return lost_asset_ids
+
+def drop_superseded_changes(zone_id, zone_plan, changes):
+    """Returns the changes that are still wanted by an asset whose claim this invocation holds, and the assets whose
+    claims a newer event has taken over.  The changes of those assets are left to the newer event."""
+    lost_asset_ids = get_lost_claims(set().union(*map(lambda x: zone_plan['owners'][get_change_key(x)], changes)))
+    if not lost_asset_ids:
+        return changes, lost_asset_ids
+    print 'Newer events have been claimed for %s; dropping their changes to zone %s' % (', '.join(sorted(lost_asset_ids)), zone_id)
+    return filter(lambda x: not zone_plan['owners'][get_change_key(x)] <= lost_asset_ids, changes), lost_asset_ids
+
+def undo_superseded_records(record_asset_id, records):
+    """Deletes the records that a create event wrote for the asset if the newer event that claimed the asset in the
+    meantime destroys it, since that event may have deleted the asset's records before they reached Route 53."""
+    event_claims.pop(record_asset_id, None)
+    try:
+        item = table.get_item(Key={'AssetId': record_asset_id}, ConsistentRead=True).get('Item', {})
+    except ClientError as e:
+        forget_table(e, table)
+        print >>sys.stderr, 'Could not check the newer event for %s\n' % record_asset_id, e
+        return
+    if records and (item.get('EventState') == 'destroy' or item.get('Destroyed')):
+        print '%s has been destroyed by event %s; deleting the records written for it' % (record_asset_id, item['EventId'])
+        delete_records(records)
+
+def get_change_plan_hash(plan, owner_id=None):
+    """Returns a hash of the changes in the change plan that doesn't depend on the order they were planned in.  Only
+    the changes planned for owner_id are hashed if it is given."""
+    changes = []
+    for zone_id, zone_plan in plan.items():
+        owned_changes = zone_plan['changes']
+        if owner_id is not None:
+            owned_changes = filter(lambda x: owner_id in zone_plan['owners'][get_change_key(x)], owned_changes)
+        changes.extend(map(lambda x: json.dumps([zone_id, x], sort_keys=True), owned_changes))
+    return hashlib.sha256('\n'.join(sorted(changes))).hexdigest()
+
+def get_record_key(zone_id, record_name, type, value):
+    """Returns the key of a record in the record index."""
+    return ' '.join([short_zone_id(zone_id), normalize_zone_name(record_name), type, value])
+
+def get_planned_records(vpc_ids):
+    """Returns the record index items of the records that the change plan UPSERTs for the assets, given as a dict of
+    asset id to VPC id.  A record planned for several assets is indexed for each of them."""
+    records = []
+    for zone_id, zone_plan in change_plan.items():
+        target = zone_plan['target'] or (None, get_aws_session().region_name)
+        for change in zone_plan['changes']:
+            action, record_name, type, value = get_change_key(change)
+            if action != 'UPSERT':
+                continue
+            for owner_id in filter(lambda x: x in vpc_ids, zone_plan['owners'][(action, record_name, type, value)]):
+                record = {
+                    'AssetId': owner_id,
+                    'RecordKey': get_record_key(zone_id, record_name, type, value),
+                    'ZoneId': short_zone_id(zone_id),
+                    'RecordName': change['ResourceRecordSet']['Name'],
+                    'RecordType': type,
+                    'RecordValue': value,
+                    'VpcId': vpc_ids[owner_id],
+                    'Region': target[1]
+                }
+                if target[0]:
+                    record['Account'] = target[0]
+                records.append(record)
+    return records
+
+def query_records(**kwargs):
+    """Yields the items of a query of the record index table, requesting pages as they are consumed."""
+    record_table = get_table(RECORD_TABLE_NAME, create_record_table)
+    while True:
+        try:
+            response = record_table.query(**kwargs)
+        except ClientError as e:
+            forget_table(e, record_table)
+            raise
+        for item in response['Items']:
+            yield item
+        if not response.get('LastEvaluatedKey'):
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def get_asset_records(record_asset_id):
+    """Returns the indexed records of the asset."""
+    return list(query_records(KeyConditionExpression='AssetId = :asset_id', ConsistentRead=True,
+                              ExpressionAttributeValues={':asset_id': record_asset_id}))
+
+def update_record_index(records, stale_records=()):
+    """Writes the records to the record index and removes the stale ones, in batches.  Records that can't be indexed
+    are left to reconcile_handler."""
+    if not records and not stale_records:
+        return
+    try:
+        with get_table(RECORD_TABLE_NAME, create_record_table).batch_writer(['AssetId', 'RecordKey']) as writer:
+            for record in stale_records:
+                writer.delete_item(Key={'AssetId': record['AssetId'], 'RecordKey': record['RecordKey']})
+            for record in records:
+                writer.put_item(Item=record)
+    except BaseException as e:
+        print >>sys.stderr, 'Could not update the record index\n', e
+
+def plan_record_deletes(records):
+    """Adds a DELETE of each indexed record to the change plan, to be submitted with the clients of the account and
+    region the record was written with."""
+    global asset_id, client_target
+    for record in records:
+        asset_id = record['AssetId']
+        client_target = get_client_target(record.get('Account'), record['Region'])
+        plan_change(record['ZoneId'], 'DELETE', record['RecordName'], record['RecordType'], record['RecordValue'])
+
+def plan_stale_record_deletes(record_asset_id, records):
+    """Returns the indexed records of the asset that aren't among its planned records, and adds a DELETE of those
+    that no planned UPSERT replaces to the change plan."""
+    record_keys = set(map(lambda x: x['RecordKey'], records))
+    record_sets = set(map(lambda x: (x['ZoneId'], normalize_zone_name(x['RecordName']), x['RecordType']), records))
+    stale_records = filter(lambda x: x['RecordKey'] not in record_keys, get_asset_records(record_asset_id))
+    plan_record_deletes(filter(lambda x: (x['ZoneId'], normalize_zone_name(x['RecordName']), x['RecordType']) not in record_sets,
+                               stale_records))
+    return stale_records
+
+def delete_records(records, coalesce=False):
+    """Deletes the indexed records from Route 53, with one batch of DELETEs per zone, and from the record index.  The
+    records of assets whose DELETEs were rejected stay in the index.  Returns the ids of those assets."""
+    print 'Deleting %d indexed record(s)' % len(records)
+    plan_record_deletes(records)
+    failed_asset_ids = flush_change_plan(coalesce)
+    update_record_index([], filter(lambda x: x['AssetId'] not in failed_asset_ids, records))
+    return failed_asset_ids
+
 def create_resource_record(zone_id, host_name, hosted_zone_name, type, value):
-    """This function creates resource records in the hosted zone passed by the calling function."""
+    """This function adds an UPSERT of the resource record to the change plan of the hosted zone passed by the calling
+    function."""
     print 'Updating %s record %s in zone %s ' % (type, host_name, hosted_zone_name)
     if host_name[-1] != '.':
         host_name = host_name + '.'
-    route53.change_resource_record_sets(
-                HostedZoneId=zone_id,
-                ChangeBatch={
-                    "Comment": "Updated by Lambda DDNS",
-                    "Changes": [
-                        {
-                            "Action": "UPSERT",
-                            "ResourceRecordSet": {
-                                "Name": host_name + hosted_zone_name,
-                                "Type": type,
-                                "TTL": 60,
-                                "ResourceRecords": [
-                                    {
-                                        "Value": value
-                                    },
-                                ]
-                            }
-                        },
-                    ]
-                }
-            )
+    plan_change(zone_id, 'UPSERT', host_name + hosted_zone_name, type, value)
 
 def delete_resource_record(zone_id, host_name, hosted_zone_name, type, value):
-    """This function deletes resource records from the hosted zone passed by the calling function."""
+    """This function adds a DELETE of the resource record to the change plan of the hosted zone passed by the calling
+    function."""
     print 'Deleting %s record %s in zone %s' % (type, host_name, hosted_zone_name)
     if host_name[-1] != '.':
         host_name = host_name + '.'
-    route53.change_resource_record_sets(
-                HostedZoneId=zone_id,
-                ChangeBatch={
-                    "Comment": "Updated by Lambda DDNS",
-                    "Changes": [
-                        {
-                            "Action": "DELETE",
-                            "ResourceRecordSet": {
-                                "Name": host_name + hosted_zone_name,
-                                "Type": type,
-                                "TTL": 60,
-                                "ResourceRecords": [
-                                    {
-                                        "Value": value
-                                    },
-                                ]
-                            }
-                        },
-                    ]
-                }
-            )
-def get_zone_id(zone_name):
-    """This function returns the zone id for the zone name that's passed into the function."""
-    if zone_name[-1] != '.':
-        zone_name = zone_name + '.'
-    hosted_zones = route53.list_hosted_zones()
-    x = filter(lambda record: record['Name'] == zone_name, hosted_zones['HostedZones'])
+    plan_change(zone_id, 'DELETE', host_name + hosted_zone_name, type, value)
+
+def plan_change(zone_id, action, record_name, type, value):
+    """Adds a change to the change plan of the hosted zone unless an identical change has already been planned."""
+    if zone_id is None:
+        raise ValueError('No hosted zone id for %s record %s' % (type, record_name))
+    zone_plan = change_plan.setdefault(zone_id, {'changes': [], 'owners': {}, 'target': client_target})
+    key = (action, normalize_zone_name(record_name), type, value)
+    if key in zone_plan['owners']:
+        print 'Skipping duplicate %s of %s record %s in zone %s' % (action, type, record_name, zone_id)
+        zone_plan['owners'][key].add(asset_id)
+        return
+    zone_plan['owners'][key] = set([asset_id])
+    zone_plan['changes'].append(
+        {
+            "Action": action,
+            "ResourceRecordSet": {
+                "Name": record_name,
+                "Type": type,
+                "TTL": 60,
+                "ResourceRecords": [
+                    {
+                        "Value": value
+                    },
+                ]
+            }
+        }
+    )
+
+def get_change_key(change):
+    """Returns the key that identifies identical changes in the change plan."""
+    record_set = change['ResourceRecordSet']
+    return (change['Action'], normalize_zone_name(record_set['Name']), record_set['Type'], record_set['ResourceRecords'][0]['Value'])
+
+def split_change_batch(changes):
+    """Splits a list of changes into batches that are within the Route 53 limits for a single ChangeBatch."""
+    batches = []
+    batch = []
+    records = 0
+    value_chars = 0
+    for change in changes:
+        weight = 2 if change['Action'] == 'UPSERT' else 1
+        change_records = weight * len(change['ResourceRecordSet']['ResourceRecords'])
+        change_value_chars = weight * sum(len(x['Value']) for x in change['ResourceRecordSet']['ResourceRecords'])
+        if batch and (records + change_records > MAX_CHANGE_BATCH_RECORDS or value_chars + change_value_chars > MAX_CHANGE_BATCH_VALUE_CHARS):
+            batches.append(batch)
+            batch = []
+            records = 0
+            value_chars = 0
+        batch.append(change)
+        records += change_records
+        value_chars += change_value_chars
+    if batch:
+        batches.append(batch)
+    return batches
+
+def get_invocation_deadline(context):
+    """Returns the time by which the invocation has to be done with Route 53, or a minute from now without a context."""
+    if context is None:
+        return time.time() + 60
+    return time.time() + context.get_remaining_time_in_millis() / 1000.0 - ROUTE53_RETRY_RESERVE
+
+def wait_for_route53_write():
+    """Waits for the container's spacing between change batches and, with DDNS_ROUTE53_RATE set, for a token from the
+    bucket shared by all containers."""
+    if route53_write_spacing:
+        time.sleep(max(0, min(route53_write_spacing, invocation_deadline - time.time())))
+    if ROUTE53_RATE > 0:
+        take_route53_token()
+
+def take_route53_token():
+    """Takes a token from the bucket in the DDNS table, waiting for the bucket to refill when it's empty.  The bucket
+    is updated with a conditional write so that two containers can't take the same token.  If no token can be had
+    before the deadline, or the table can't be used, the write goes ahead and relies on being retried."""
+    capacity = max(1.0, ROUTE53_RATE)
+    while True:
+        now = time.time()
+        try:
+            item = table.get_item(Key={'AssetId': ROUTE53_TOKEN_BUCKET_KEY}, ConsistentRead=True).get('Item')
+            tokens = capacity
+            if item:
+                tokens = min(capacity, float(item['Tokens']) + (now - float(item['UpdatedAt'])) * ROUTE53_RATE)
+            if tokens >= 1:
+                condition = {'ConditionExpression': 'attribute_not_exists(AssetId)'}
+                if item:
+                    condition = {'ConditionExpression': 'UpdatedAt = :updated_at', 'ExpressionAttributeValues': {':updated_at': item['UpdatedAt']}}
+                table.put_item(
+                    Item={
+                        'AssetId': ROUTE53_TOKEN_BUCKET_KEY,
+                        'Tokens': Decimal('%.6f' % (tokens - 1)),
+                        'UpdatedAt': Decimal('%.6f' % now)
+                    },
+                    **condition
+                )
+                return
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                forget_table(e, table)
+                print >>sys.stderr, 'Could not take a token from the Route 53 token bucket\n', e
+                return
+            # Another container took a token in the meantime.  Back off so that competing containers don't keep
+            # reading and writing the bucket.
+            wait = random.uniform(0, ROUTE53_TOKEN_CONFLICT_DELAY)
+            if time.time() + wait >= invocation_deadline:
+                print 'No Route 53 token left before the deadline'
+                return
+            time.sleep(wait)
+            continue
+        wait = (1 - tokens) / ROUTE53_RATE
+        if now + wait >= invocation_deadline:
+            print 'No Route 53 token left before the deadline'
+            return
+        time.sleep(wait)
+
+def change_resource_record_sets(zone_id, changes):
+    """Calls ChangeResourceRecordSets, retrying while Route 53 throttles the call and the deadline allows."""
+    global route53_write_spacing
+    delay = ROUTE53_RETRY_BASE_DELAY
+    attempts = 0
+    while True:
+        attempts += 1
+        wait_for_route53_write()
+        try:
+            route53.change_resource_record_sets(
+                        HostedZoneId=zone_id,
+                        ChangeBatch={
+                            "Comment": "Updated by Lambda DDNS",
+                            "Changes": changes
+                        }
+                    )
+            route53_write_spacing = route53_write_spacing / 2 if route53_write_spacing > 0.01 else 0
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ROUTE53_RETRY_ERRORS:
+                raise
+            route53_write_spacing = min(ROUTE53_RETRY_MAX_DELAY, max(ROUTE53_RETRY_BASE_DELAY, route53_write_spacing * 2))
+            delay = min(ROUTE53_RETRY_MAX_DELAY, random.uniform(ROUTE53_RETRY_BASE_DELAY, delay * 3))
+            if time.time() + delay + route53_write_spacing >= invocation_deadline:
+                print >>sys.stderr, 'Giving up on the change batch for zone %s after %d attempt(s)' % (zone_id, attempts)
+                raise
+            print 'Change batch for zone %s was throttled (%s), retrying in %.2fs' % (zone_id, e.response['Error']['Code'], delay)
+            time.sleep(delay)
+
+def submit_change_batch(zone_id, changes):
+    """Submits a list of changes to the hosted zone as one ChangeBatch.  Returns the changes that were rejected."""
+    print 'Submitting %d change(s) to zone %s' % (len(changes), zone_id)
     try:
-        zone_id_long = x[0]['Id']
-        zone_id = str.split(str(zone_id_long),'/')[2]
-        return zone_id
-    except:
+        change_resource_record_sets(zone_id, changes)
+    except ClientError as e:
+        print >>sys.stderr, e
+        # Route 53 rejects the whole batch when one of its changes is invalid, e.g. the DELETE of a record that has
+        # already been removed.  Submit the changes one at a time so that the valid ones are still applied.
+        if e.response['Error']['Code'] == 'InvalidChangeBatch' and len(changes) > 1:
+            print 'Submitting the changes to zone %s one at a time' % zone_id
+            failed_changes = []
+            for change in changes:
+                failed_changes.extend(submit_change_batch(zone_id, [change]))
+            return failed_changes
+        # A DELETE is rejected when the record is already gone or no longer has our value, neither of which needs
+        # to be retried.
+        if e.response['Error']['Code'] == 'InvalidChangeBatch' and changes[0]['Action'] == 'DELETE':
+            return []
+        return changes
+    except BaseException as e:
+        print >>sys.stderr, e
+        return changes
+    return []
+
+def flush_change_plan(coalesce=False):
+    """Submits the change plan to Route 53 with one ChangeResourceRecordSets call per hosted zone and clears it.
+    Returns the ids of the assets whose changes were rejected.  Set coalesce to True to queue the changes for the
+    holder of each zone's lease instead; the assets whose queued changes this invocation didn't submit itself, because
+    another invocation holds the lease or the deadline came first, are returned as well, since they may not have been
+    applied yet."""
+    global change_plan, client_target
+    failed_asset_ids = set()
+    queued_plans = {}
+    for zone_id, zone_plan in change_plan.items():
+        # Submit the changes with the clients of the account the zone is in
+        client_target = zone_plan['target']
+        if coalesce:
+            zone_plan['changes'], lost_asset_ids = drop_superseded_changes(zone_id, zone_plan, zone_plan['changes'])
+            failed_asset_ids.update(lost_asset_ids)
+            if not zone_plan['changes']:
+                continue
+            if queue_changes(zone_id, zone_plan['changes']):
+                queued_plans[zone_id] = zone_plan
+                continue
+        for changes in split_change_batch(zone_plan['changes']):
+            # A newer event may have claimed an asset while earlier batches were being submitted
+            changes, lost_asset_ids = drop_superseded_changes(zone_id, zone_plan, changes)
+            failed_asset_ids.update(lost_asset_ids)
+            if not changes:
+                continue
+            for change in submit_change_batch(zone_id, changes):
+                failed_asset_ids.update(zone_plan['owners'][get_change_key(change)])
+    change_plan = {}
+
+    leased_zone_ids = []
+    for zone_id, zone_plan in queued_plans.items():
+        client_target = zone_plan['target']
+        if acquire_change_lease(zone_id):
+            leased_zone_ids.append(zone_id)
+        else:
+            print 'The changes queued for zone %s are left to the holder of its lease' % zone_id
+            failed_asset_ids.update(*zone_plan['owners'].values())
+    if leased_zone_ids:
+        # Give the other invocations of a burst time to queue their changes
+        time.sleep(max(0, min(COALESCE_WINDOW, invocation_deadline - time.time())))
+        for zone_id in leased_zone_ids:
+            zone_plan = queued_plans[zone_id]
+            client_target = zone_plan['target']
+            applied_keys = set(map(get_change_key, drain_change_queue(zone_id)))
+            for change in filter(lambda x: get_change_key(x) not in applied_keys, zone_plan['changes']):
+                failed_asset_ids.update(zone_plan['owners'][get_change_key(change)])
+    return failed_asset_ids
+
+def queue_changes(zone_id, changes):
+    """Appends changes to the queue of the zone in the DDNS table.  Returns False if they couldn't be queued."""
+    try:
+        table.update_item(
+            Key={
+                'AssetId': 'change-queue#' + zone_id
+            },
+            UpdateExpression='SET Changes = list_append(if_not_exists(Changes, :empty), :changes)',
+            ExpressionAttributeValues={
+                ':empty': [],
+                ':changes': map(json.dumps, changes)
+            }
+        )
+    except ClientError as e:
+        forget_table(e, table)
+        print >>sys.stderr, 'Could not queue the changes for zone %s, submitting them now\n' % zone_id, e
+        return False
+    print 'Queued %d change(s) for zone %s' % (len(changes), zone_id)
+    return True
+
+def acquire_change_lease(zone_id):
+    """Takes the lease that allows this invocation to submit the changes queued for the zone.  Returns False if another
+    invocation holds it."""
+    owner = str(uuid.uuid4())
+    try:
+        table.put_item(
+            Item={
+                'AssetId': 'change-lease#' + zone_id,
+                'Owner': owner,
+                'ExpiresAt': Decimal('%.6f' % (invocation_deadline + ROUTE53_RETRY_RESERVE))
+            },
+            ConditionExpression='attribute_not_exists(AssetId) OR ExpiresAt < :now',
+            ExpressionAttributeValues={
+                ':now': Decimal('%.6f' % time.time())
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print >>sys.stderr, 'Could not take the lease for zone %s\n' % zone_id, e
+        return False
+    change_leases[zone_id] = owner
+    return True
+
+def release_change_lease(zone_id):
+    """Gives up the lease of the zone if this invocation still holds it."""
+    try:
+        table.delete_item(
+            Key={
+                'AssetId': 'change-lease#' + zone_id
+            },
+            ConditionExpression='#owner = :owner',
+            ExpressionAttributeNames={
+                '#owner': 'Owner'
+            },
+            ExpressionAttributeValues={
+                ':owner': change_leases.pop(zone_id)
+            }
+        )
+    except ClientError as e:
+        print >>sys.stderr, 'Could not release the lease for zone %s\n' % zone_id, e
+
+def take_queued_changes(zone_id):
+    """Removes the queue of the zone from the DDNS table and returns the changes that were in it."""
+    item = table.delete_item(
+        Key={
+            'AssetId': 'change-queue#' + zone_id
+        },
+        ReturnValues='ALL_OLD'
+    ).get('Attributes', {})
+    return map(json.loads, item.get('Changes', []))
+
+def merge_queued_changes(changes):
+    """Keeps only the last queued change of each resource record set, in the order the changes were queued.  Later
+    events about a record supersede earlier ones, and Route 53 doesn't allow two changes of a record in a batch."""
+    latest = {}
+    for position, change in enumerate(changes):
+        latest[(normalize_zone_name(change['ResourceRecordSet']['Name']), change['ResourceRecordSet']['Type'])] = (position, change)
+    return map(lambda x: x[1], sorted(latest.values()))
+
+def drain_change_queue(zone_id):
+    """Submits the changes queued for the zone as merged change batches until the queue is empty or the deadline
+    nears, then releases the lease.  The changes that were rejected or that there was no time left to submit are
+    queued again before the lease is released.  The queue is checked once more after that, since an invocation that
+    queued changes while the lease was held relies on the holder to submit them.  Returns the changes that were
+    applied."""
+    applied_changes = []
+    unsubmitted_changes = []
+    while True:
+        while time.time() < invocation_deadline:
+            try:
+                changes = take_queued_changes(zone_id)
+            except ClientError as e:
+                print >>sys.stderr, 'Could not take the queued changes for zone %s\n' % zone_id, e
+                break
+            if not changes:
+                break
+            merged_changes = merge_queued_changes(unsubmitted_changes + changes)
+            unsubmitted_changes = []
+            print 'Submitting %d queued change(s) as %d for zone %s' % (len(changes), len(merged_changes), zone_id)
+            for batch in split_change_batch(merged_changes):
+                if time.time() >= invocation_deadline:
+                    unsubmitted_changes.extend(batch)
+                    continue
+                rejected_changes = submit_change_batch(zone_id, batch)
+                unsubmitted_changes.extend(rejected_changes)
+                applied_changes.extend(filter(lambda x: x not in rejected_changes, batch))
+        if unsubmitted_changes and not queue_changes(zone_id, unsubmitted_changes):
+            print >>sys.stderr, 'Dropped %d change(s) for zone %s that could not be queued again' % (len(unsubmitted_changes), zone_id)
+        release_change_lease(zone_id)
+        if time.time() >= invocation_deadline:
+            return applied_changes
+        # Changes that were only queued again by this invocation are left for the next one that queues changes
+        try:
+            item = table.get_item(Key={'AssetId': 'change-queue#' + zone_id}, ConsistentRead=True).get('Item', {})
+        except ClientError as e:
+            print >>sys.stderr, 'Could not check the queue of zone %s\n' % zone_id, e
+            return applied_changes
+        if len(item.get('Changes', [])) <= len(unsubmitted_changes) or not acquire_change_lease(zone_id):
+            return applied_changes
+        unsubmitted_changes = []
+
+def iter_resource_record_sets(zone_id):
+    """Yields the resource record sets of the hosted zone, requesting pages as they are consumed so that a zone of any
+    size can be compared without holding it in memory."""
+    kwargs = {'HostedZoneId': zone_id}
+    while True:
+        response = route53.list_resource_record_sets(**kwargs)
+        for record_set in response['ResourceRecordSets']:
+            yield record_set
+        if not response['IsTruncated']:
+            return
+        kwargs = {'HostedZoneId': zone_id, 'StartRecordName': response['NextRecordName'], 'StartRecordType': response['NextRecordType']}
+        if response.get('NextRecordIdentifier'):
+            kwargs['StartRecordIdentifier'] = response['NextRecordIdentifier']
+
+def get_record_values(record_set):
+    """Returns the values of the record set in a form that can be compared with another record set's."""
+    return sorted(map(lambda x: x['Value'].strip().lower().rstrip('.'), record_set.get('ResourceRecords', [])))
+
+def get_reconcile_records(zone_id, target):
+    """Returns the indexed records of the zone that this function wrote for assets in the account and region of the
+    target, keyed by record name, type and value.  Records that are also indexed for another account or region are
+    left out, since their assets aren't described when this account and region are reconciled."""
+    target = target or (None, get_aws_session().region_name)
+    records = {}
+    shared_keys = set()
+    for record in query_records(IndexName=RECORD_ZONE_INDEX, KeyConditionExpression='ZoneId = :zone_id',
+                                ExpressionAttributeValues={':zone_id': short_zone_id(zone_id)}):
+        key = (normalize_zone_name(record['RecordName']), record['RecordType'], record['RecordValue'])
+        if record.get('Account') == target[0] and record['Region'] == target[1]:
+            records.setdefault(key, []).append(record)
+        else:
+            shared_keys.add(key)
+    for key in shared_keys:
+        records.pop(key, None)
+    return records
+
+def reconcile_zone(zone_id, wanted_changes, indexed_records, dry_run):
+    """Compares the wanted UPSERTs of the zone with the records in the zone and submits only the differences: an
+    UPSERT of every wanted record that is missing or has another value or TTL, and, unless indexed_records is None, a
+    DELETE of every record that isn't wanted but is among indexed_records, as returned by get_reconcile_records.  The
+    index items of deleted records are removed as well.  Only the wanted records are kept in memory; the zone is read a
+    page at a time and DELETEs are submitted as soon as there are enough for a batch.  Returns counts of unchanged,
+    upserted, deleted and failed records."""
+    wanted = {}
+    for change in wanted_changes:
+        record_set = change['ResourceRecordSet']
+        wanted[(normalize_zone_name(record_set['Name']), record_set['Type'])] = record_set
+    counts = {'unchanged': 0, 'upserts': 0, 'deletes': 0, 'failed': 0}
+
+    def submit(changes):
+        for change in changes:
+            counts[change['Action'].lower() + 's'] += 1
+            if dry_run:
+                print 'Would %s %s record %s in zone %s' % (change['Action'], change['ResourceRecordSet']['Type'],
+                                                           change['ResourceRecordSet']['Name'], zone_id)
+        if not dry_run:
+            for batch in split_change_batch(changes):
+                failed_changes = submit_change_batch(zone_id, batch)
+                counts['failed'] += len(failed_changes)
+                deleted_keys = map(lambda x: get_change_key(x)[1:], filter(lambda x: x['Action'] == 'DELETE' and x not in failed_changes, batch))
+                update_record_index([], sum(map(lambda x: indexed_records[x], deleted_keys), []))
+
+    deletes = []
+    try:
+        for record_set in iter_resource_record_sets(zone_id):
+            key = (normalize_zone_name(record_set['Name']), record_set['Type'])
+            wanted_record_set = wanted.get(key)
+            if wanted_record_set is not None:
+                if record_set.get('TTL') == wanted_record_set['TTL'] and get_record_values(record_set) == get_record_values(wanted_record_set):
+                    del wanted[key]
+                    counts['unchanged'] += 1
+            elif (indexed_records is not None and len(record_set.get('ResourceRecords', [])) == 1 and
+                    get_change_key({'Action': 'DELETE', 'ResourceRecordSet': record_set})[1:] in indexed_records):
+                deletes.append({'Action': 'DELETE', 'ResourceRecordSet': record_set})
+                if len(deletes) >= MAX_CHANGE_BATCH_RECORDS:
+                    submit(deletes)
+                    deletes = []
+    except ClientError as e:
+        print >>sys.stderr, 'Could not list the records of zone %s\n' % zone_id, e
+        counts['failed'] += len(wanted)
+        return counts
+    submit(deletes)
+    submit(map(lambda x: {'Action': 'UPSERT', 'ResourceRecordSet': x}, wanted.values()))
+    return counts
+
+def normalize_zone_name(zone_name):
+    """Returns the zone name in the form used as a key by the hosted zone index, i.e. lower case with a trailing dot."""
+    zone_name = zone_name.strip().lower()
+    if zone_name and zone_name[-1] != '.':
+        zone_name = zone_name + '.'
+    return zone_name
+
+def short_zone_id(zone_id):
+    """Strips the /hostedzone/ prefix from the hosted zone id returned by Route 53."""
+    return str.split(str(zone_id),'/')[-1]
+
+def get_zone_sort_key(zone_name):
+    """Returns the key that Route 53 orders the zones it lists by, the labels of the name from right to left."""
+    return tuple(get_zone_labels(zone_name))
+
+def list_hosted_zones_from(zone_name):
+    """Lists a page of the hosted zones from zone_name on, and more pages while the zones called zone_name continue.
+    Returns the zones and the sort key of the first zone that wasn't listed, or None if the list has ended."""
+    hosted_zones = []
+    kwargs = {'DNSName': normalize_zone_name(zone_name), 'MaxItems': str(MAX_ZONE_LOOKUP_ITEMS)}
+    while True:
+        response = route53.list_hosted_zones_by_name(**kwargs)
+        hosted_zones.extend(response['HostedZones'])
+        if not response['IsTruncated']:
+            return hosted_zones, None
+        if get_zone_sort_key(response['NextDNSName']) != get_zone_sort_key(zone_name):
+            return hosted_zones, get_zone_sort_key(response['NextDNSName'])
+        kwargs.update({'DNSName': response['NextDNSName'], 'HostedZoneId': response['NextHostedZoneId']})
+
+def iter_hosted_zones_by_vpc(vpc_id, region):
+    """Yields a summary of every private hosted zone associated with the VPC, requesting pages as they are consumed."""
+    kwargs = {'VPCId': vpc_id, 'VPCRegion': region}
+    while True:
+        hosted_zones = route53.list_hosted_zones_by_vpc(**kwargs)
+        for hosted_zone in hosted_zones['HostedZoneSummaries']:
+            yield hosted_zone
+        if not hosted_zones.get('NextToken'):
+            return
+        kwargs['NextToken'] = hosted_zones['NextToken']
+
+def get_zone_labels(zone_name):
+    """Returns the labels of the name from right to left, i.e. in the order they are looked up in the zone trie."""
+    labels = normalize_zone_name(zone_name).split('.')[:-1]
+    labels.reverse()
+    return labels
+
+def get_hosted_zone_trie(zone_names=()):
+    """Returns the root node of the zone trie of the account, once every name in zone_names is covered by a lookup
+    since the trie was last emptied.  Each node has the child nodes of the next labels and the first 'any', 'private'
+    and 'public' zone with its name.  Route 53 is called without holding the lock."""
+    account_id = client_target and client_target[0]
+    with hosted_zone_trie_lock:
+        trie = hosted_zone_index['tries'].get(account_id)
+        if trie is None or time.time() >= trie['expires']:
+            trie = {'expires': time.time() + ZONE_CACHE_TTL, 'root': {'labels': {}, 'any': None, 'private': None, 'public': None},
+                    'covered': []}
+            hosted_zone_index['tries'][account_id] = trie
+    # Look the names up in the order Route 53 lists them, so that one page can cover several of them
+    for zone_key in sorted(set(map(get_zone_sort_key, zone_names))):
+        if any(start <= zone_key and (end is None or zone_key < end) for start, end in trie['covered']):
+            continue
+        hosted_zones, end = list_hosted_zones_from('.'.join(reversed(zone_key)))
+        with hosted_zone_trie_lock:
+            for hosted_zone in hosted_zones:
+                add_zone_to_trie(trie['root'], hosted_zone)
+            trie['covered'].append((zone_key, end))
+    return trie['root']
+
+def add_zone_to_trie(root, hosted_zone):
+    """Adds a hosted zone, as returned by Route 53, to the zone trie and returns its Name and Id."""
+    node = root
+    for label in get_zone_labels(hosted_zone['Name']):
+        node = node['labels'].setdefault(label, {'labels': {}, 'any': None, 'private': None, 'public': None})
+    zone = {'Name': hosted_zone['Name'], 'Id': short_zone_id(hosted_zone['Id'])}
+    kind = 'private' if hosted_zone['Config']['PrivateZone'] else 'public'
+    if node['any'] is None:
+        node['any'] = zone
+    if node[kind] is None:
+        node[kind] = zone
+    return zone
+
+def find_zone(zone_name, private=None):
+    """Returns the Name and Id of the hosted zone called zone_name.  Set private to True or False to only match private
+    or public zones respectively.  Returns None when there's no matching zone."""
+    if not zone_name:
         return None
+    node = get_hosted_zone_trie([zone_name])
+    for label in get_zone_labels(zone_name):
+        node = node['labels'].get(label)
+        if node is None:
+            return None
+    return node['any' if private is None else 'private' if private else 'public']
+
+def find_zone_for_name(host_name, private=None):
+    """Returns the Name and Id of the most specific hosted zone that host_name belongs to, not counting a zone called
+    host_name itself.  Set private to True or False to only match private or public zones respectively.  Returns None
+    when there's no matching zone."""
+    kind = 'any' if private is None else 'private' if private else 'public'
+    labels = get_zone_labels(host_name)
+    node = get_hosted_zone_trie(map(lambda x: '.'.join(reversed(labels[:x])), range(1, len(labels))))
+    zone = None
+    for label in labels[:-1]:
+        node = node['labels'].get(label)
+        if node is None:
+            break
+        zone = node[kind] or zone
+    return zone
+
+def get_relative_name(host_name, zone_name):
+    """Returns the part of host_name that comes before the name of its zone."""
+    labels = normalize_zone_name(host_name).split('.')[:-1]
+    return '.'.join(labels[:len(labels) - len(get_zone_labels(zone_name))])
+
+def get_vpc_hosted_zones(vpc_id, region):
+    """Returns the private hosted zones associated with the VPC, keyed by normalized zone name."""
+    key = (region, vpc_id)
+    entry = hosted_zone_index['vpcs'].get(key)
+    if entry is None or time.time() >= entry['expires']:
+        zones = {}
+        for hosted_zone in iter_hosted_zones_by_vpc(vpc_id, region):
+            zone = {'Name': hosted_zone['Name'], 'Id': short_zone_id(hosted_zone['HostedZoneId'])}
+            zones.setdefault(normalize_zone_name(hosted_zone['Name']), zone)
+            get_zone_associations(zone['Id'])['vpcs'].add(key)
+        entry = {'expires': time.time() + ZONE_CACHE_TTL, 'zones': zones}
+        hosted_zone_index['vpcs'][key] = entry
+    return entry['zones']
+
+def get_zone_associations(zone_id):
+    """Returns the association map entry of the zone.  Its 'vpcs' are the (region, VPC id) pairs known to be associated
+    with the zone, and 'complete' says whether they are all of them."""
+    entry = hosted_zone_index['associations'].get(zone_id)
+    if entry is None or time.time() >= entry['expires']:
+        entry = {'expires': time.time() + ZONE_CACHE_TTL, 'vpcs': set(), 'complete': False}
+        hosted_zone_index['associations'][zone_id] = entry
+    return entry
+
+def is_zone_associated(zone_id, vpc_id, region):
+    """Returns True if the private hosted zone is associated with the VPC.  Route 53 is only asked when neither the
+    association map nor the zones listed for the VPC can tell."""
+    key = (region, vpc_id)
+    associations = get_zone_associations(zone_id)
+    if key in associations['vpcs']:
+        return True
+    if associations['complete']:
+        return False
+    vpc_entry = hosted_zone_index['vpcs'].get(key)
+    if vpc_entry is not None and time.time() < vpc_entry['expires']:
+        return False
+    hosted_zone_properties = get_hosted_zone_properties(zone_id)
+    associations['vpcs'].update(map(lambda x: (x['VPCRegion'], x['VPCId']), hosted_zone_properties['VPCs']))
+    associations['complete'] = True
+    return key in associations['vpcs']
+
+def record_zone_association(zone, vpc_id, region):
+    """Records in the zone index that the zone has been associated with the VPC."""
+    key = (region, vpc_id)
+    get_zone_associations(zone['Id'])['vpcs'].add(key)
+    vpc_entry = hosted_zone_index['vpcs'].get(key)
+    if vpc_entry is not None:
+        vpc_entry['zones'][normalize_zone_name(zone['Name'])] = zone
 
 def is_valid_hostname(hostname):
     """This function checks to see whether the hostname entered into the zone and cname tags is a valid hostname."""
@@ -501,46 +2348,166 @@ def is_valid_hostname(hostname):
     allowed = re.compile("(?!-)[A-Z\d-]{1,63}(?<!-)$", re.IGNORECASE)
     return all(allowed.match(x) for x in hostname.split("."))
 
+def get_cached_metadata(cache_key, load, refresh=False):
+    """Returns the metadata cached under cache_key.  When the entry is missing or has expired it is read from the
+    shared cache if that's enabled, and otherwise loaded by calling load.  Set refresh to True to always call load."""
+    entry = vpc_metadata_cache.get(cache_key)
+    if not refresh and entry is not None and time.time() < entry['expires']:
+        return entry['metadata']
+    entry = None
+    if VPC_CACHE_SHARED and not refresh:
+        try:
+            item = get_table('DDNS').get_item(Key={'AssetId': cache_key}).get('Item')
+            if item and time.time() < item['ExpiresAt']:
+                entry = {'expires': float(item['ExpiresAt']), 'metadata': item['Metadata']}
+        except BaseException as e:
+            print >>sys.stderr, 'Could not read %s from the shared cache\n' % cache_key, e
+    if entry is None:
+        entry = {'expires': time.time() + VPC_CACHE_TTL, 'metadata': load()}
+        if VPC_CACHE_SHARED:
+            try:
+                get_table('DDNS').put_item(
+                    Item={
+                        'AssetId': cache_key,
+                        'Metadata': entry['metadata'],
+                        'ExpiresAt': int(entry['expires'])
+                    }
+                )
+            except BaseException as e:
+                print >>sys.stderr, 'Could not write %s to the shared cache\n' % cache_key, e
+    vpc_metadata_cache[cache_key] = entry
+    return entry['metadata']
+
+def load_vpc_metadata(vpc_id):
+    """Returns the DNS attributes and the DHCP option set domains of the VPC.  The domains are None if the VPC has no
+    DHCP option set.  Any other error is raised, so that it isn't cached as a VPC without one."""
+    def load_dhcp_configurations():
+        dhcp_options_id = compute.describe_vpcs(VpcIds=[vpc_id])['Vpcs'][0]['DhcpOptionsId']
+        if dhcp_options_id == 'default':
+            return None
+        try:
+            return get_dhcp_configurations(dhcp_options_id)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidDhcpOptionID.NotFound':
+                raise
+            print 'The DHCP option set %s of VPC %s no longer exists\n' % (dhcp_options_id, vpc_id), e
+            return None
+    return run_concurrently({
+        'dns_hostnames': lambda: is_dns_hostnames_enabled(vpc_id),
+        'dns_support': lambda: is_dns_support_enabled(vpc_id),
+        'dhcp_configurations': load_dhcp_configurations
+    })
+
+def get_vpc_metadata(vpc_id, refresh=False):
+    """Returns the cached DNS attributes and DHCP option set domains of the VPC."""
+    return get_cached_metadata('vpc-metadata#' + vpc_id, lambda: load_vpc_metadata(vpc_id), refresh)
+
+def load_subnet_metadata(subnet_id):
+    """Returns the IPv4 CIDR block of the subnet and its IPv6 CIDR block, if it has one."""
+    subnet = compute.describe_subnets(SubnetIds=[subnet_id])['Subnets'][0]
+    metadata = {'cidr_block': subnet['CidrBlock']}
+    for association in subnet.get('Ipv6CidrBlockAssociationSet', []):
+        if association['Ipv6CidrBlockState']['State'] == 'associated':
+            metadata['ipv6_cidr_block'] = association['Ipv6CidrBlock']
+            break
+    return metadata
+
+def get_subnet_metadata(subnet_id, refresh=False):
+    """Returns the cached CIDR blocks of the subnet."""
+    return get_cached_metadata('subnet-metadata#' + subnet_id, lambda: load_subnet_metadata(subnet_id), refresh)
+
 def get_dhcp_configurations(dhcp_options_id):
     """This function returns the names of the zones/domains that are in the option set."""
     zone_names = []
-    dhcp_options = ec2.DhcpOptions(dhcp_options_id)
-    dhcp_configurations = dhcp_options.dhcp_configurations
+    dhcp_configurations = compute.describe_dhcp_options(DhcpOptionsIds=[dhcp_options_id])['DhcpOptions'][0]['DhcpConfigurations']
     for configuration in dhcp_configurations:
         zone_names.append(map(lambda x: x['Value'] + '.', configuration['Values']))
     return zone_names
 
-def reverse_list(list):
-    """Reverses the order of the asset's IP address and helps construct the reverse lookup zone name."""
-    if (re.search('\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3}',list)) or (re.search('\d{1,3}.\d{1,3}.\d{1,3}\.',list)) or (re.search('\d{1,3}.\d{1,3}\.',list)) or (re.search('\d{1,3}\.',list)):
-        list = str.split(str(list),'.')
-        list = filter(None, list)
-        list.reverse()
-        reversed_list = ''
-        for item in list:
-            reversed_list = reversed_list + item + '.'
-        return reversed_list
-    else:
-        print 'Not a valid ip'
-        sys.exit()
+def get_address_labels(ip_address):
+    """Returns the labels of the IP address in the order they are written, the decimal octets of an IPv4 address or the
+    hex nibbles of an IPv6 address.  The Python 2.7 runtime has no ipaddress module, so the address is parsed, and
+    rejected if it isn't valid, by socket.inet_pton."""
+    if ':' in ip_address:
+        return list(binascii.hexlify(socket.inet_pton(socket.AF_INET6, ip_address)))
+    return map(str, bytearray(socket.inet_pton(socket.AF_INET, ip_address)))
 
-def get_reversed_domain_prefix(subnet_mask, private_ip):
-    """Uses the mask to get the zone prefix for the reverse lookup zone"""
-    if 32 >= subnet_mask >= 24:
-        third_octet = re.search('\d{1,3}.\d{1,3}.\d{1,3}.',private_ip)
-        return third_octet.group(0)
-    elif 24 > subnet_mask >= 16:
-        second_octet = re.search('\d{1,3}.\d{1,3}.', private_ip)
-        return second_octet.group(0)
-    else:
-        first_octet = re.search('\d{1,3}.', private_ip)
-        return first_octet.group(0)
-
-def create_reverse_lookup_zone(vpc_id, reversed_domain_prefix, region):
-    """Creates the reverse lookup zone."""
-    print 'Creating reverse lookup zone %s' % reversed_domain_prefix + 'in.addr.arpa.'
-    route53.create_hosted_zone(
-        Name = reversed_domain_prefix + 'in-addr.arpa.',
+def get_reverse_domain(ip_address):
+    """Returns the reverse lookup domain of the IP address or CIDR block."""
+    return 'ip6.arpa.' if ':' in ip_address else 'in-addr.arpa.'
+
+def get_ptr_name(ip_address):
+    """Returns the name of the PTR record of the IP address, e.g. 10.2.1.10.in-addr.arpa. for 10.1.2.10."""
+    return '.'.join(reversed(get_address_labels(ip_address))) + '.' + get_reverse_domain(ip_address)
+
+def get_reverse_zone_name(cidr_block):
+    """Returns the name of the reverse lookup zone of the CIDR block: the zone of the octets of an IPv4 block or the
+    nibbles of an IPv6 block that the prefix covers in full, e.g. 2.1.10.in-addr.arpa. for 10.1.2.0/26,
+    1.10.in-addr.arpa. for 10.1.0.0/20 and the zone of the first 16 nibbles for an IPv6 /64."""
+    ip_address, prefix_length = cidr_block.split('/')
+    labels = get_address_labels(ip_address)
+    label_bits = 4 if ':' in ip_address else 8
+    count = max(1, min(len(labels) - 1, int(prefix_length) // label_bits))
+    return '.'.join(reversed(labels[:count])) + '.' + get_reverse_domain(ip_address)
+
+def get_cached_subnet_reverse_zones(subnet_id):
+    """Returns the reverse lookup zones of the subnet from the zone index, or None if they aren't cached."""
+    entry = hosted_zone_index['subnets'].get(subnet_id)
+    if entry is None or time.time() >= entry['expires']:
+        return None
+    return entry['zones']
+
+def get_subnet_reverse_zones(subnet_id, vpc_id, region, create=False, plan_only=False):
+    """Returns the reverse lookup zones of the subnet's CIDR blocks, keyed by reverse lookup domain.  A zone that
+    exists is associated with the VPC if it isn't already; you don't need to do this for a zone that is created because
+    the association is done automatically.  Set create to True to create the zones that don't exist, and plan_only to
+    True to only print the zones that would be created or associated.  The zones are cached in the zone index once all
+    of them are found and associated."""
+    zones = get_cached_subnet_reverse_zones(subnet_id)
+    if zones is not None:
+        return zones
+    subnet_metadata = get_subnet_metadata(subnet_id)
+    zones = {}
+    complete = True
+    for cidr_block in filter(None, [subnet_metadata['cidr_block'], subnet_metadata.get('ipv6_cidr_block')]):
+        zone_name = get_reverse_zone_name(cidr_block)
+        print 'The reverse lookup zone for %s is: %s' % (cidr_block, zone_name)
+        zone = get_vpc_hosted_zones(vpc_id, region).get(normalize_zone_name(zone_name)) or find_zone(zone_name)
+        if zone:
+            print 'Reverse lookup zone found:', zone_name
+            if is_zone_associated(zone['Id'], vpc_id, region):
+                print 'Reverse lookup zone %s is associated with VPC %s' % (zone['Id'], vpc_id)
+            elif plan_only:
+                print 'Would associate zone %s with VPC %s' % (zone['Id'], vpc_id)
+                complete = False
+            else:
+                print 'Associating zone %s with VPC %s' % (zone['Id'], vpc_id)
+                try:
+                    associate_zone(zone['Id'], region, vpc_id)
+                    record_zone_association(zone, vpc_id, region)
+                except BaseException as e:
+                    print >>sys.stderr, e
+                    complete = False
+        elif create and plan_only:
+            print 'Would create reverse lookup zone %s' % zone_name
+            complete = False
+        elif create:
+            # create private hosted zone for reverse lookups if it is needed
+            zone = create_reverse_lookup_zone(vpc_id, zone_name, region)
+        else:
+            print 'No matching reverse lookup zone'
+            complete = False
+        if zone:
+            zones[get_reverse_domain(cidr_block)] = zone
+    if complete:
+        hosted_zone_index['subnets'][subnet_id] = {'expires': time.time() + ZONE_CACHE_TTL, 'zones': zones}
+    return zones
+
+def create_reverse_lookup_zone(vpc_id, zone_name, region):
+    """Creates the reverse lookup zone and returns it."""
+    print 'Creating reverse lookup zone %s' % zone_name
+    hosted_zone = route53.create_hosted_zone(
+        Name = zone_name,
         VPC = {
             'VPCRegion':region,
             'VPCId': vpc_id
@@ -550,6 +2517,15 @@ def create_reverse_lookup_zone(vpc_id, reversed_domain_prefix, region):
             'Comment': 'Updated by Lambda DDNS',
         },
     )
+    # Add the zone to the cached zone index so that it reflects Route 53 again
+    with hosted_zone_trie_lock:
+        trie = hosted_zone_index['tries'].get(client_target and client_target[0])
+        if trie is not None:
+            zone = add_zone_to_trie(trie['root'], hosted_zone['HostedZone'])
+        else:
+            zone = {'Name': hosted_zone['HostedZone']['Name'], 'Id': short_zone_id(hosted_zone['HostedZone']['Id'])}
+    record_zone_association(zone, vpc_id, region)
+    return zone
 
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
@@ -559,11 +2535,23 @@ def json_serial(obj):
     raise TypeError ("Type not serializable")
 
 def remove_empty_from_dict(d):
-    """Removes empty keys from dictionary"""
+    """Removes empty keys from dictionary and converts datetimes to strings.  Each value is only visited once."""
     if type(d) is dict:
-        return dict((k, remove_empty_from_dict(v)) for k, v in d.iteritems() if v and remove_empty_from_dict(v))
+        cleaned = {}
+        for k, v in d.iteritems():
+            v = remove_empty_from_dict(v)
+            if v:
+                cleaned[k] = v
+        return cleaned
     elif type(d) is list:
-        return [remove_empty_from_dict(v) for v in d if v and remove_empty_from_dict(v)]
+        cleaned = []
+        for v in d:
+            v = remove_empty_from_dict(v)
+            if v:
+                cleaned.append(v)
+        return cleaned
+    elif isinstance(d, datetime):
+        return json_serial(d)
     else:
         return d
 
@@ -578,16 +2566,18 @@ def associate_zone(hosted_zone_id, region, vpc_id):
         Comment='Updated by Lambda DDNS'
     )
 
-def is_dns_hostnames_enabled(vpc):
-    dns_hostnames_enabled = vpc.describe_attribute(
+def is_dns_hostnames_enabled(vpc_id):
+    dns_hostnames_enabled = compute.describe_vpc_attribute(
     DryRun=False,
+    VpcId=vpc_id,
     Attribute='enableDnsHostnames'
 )
     return dns_hostnames_enabled['EnableDnsHostnames']['Value']
 
-def is_dns_support_enabled(vpc):
-    dns_support_enabled = vpc.describe_attribute(
+def is_dns_support_enabled(vpc_id):
+    dns_support_enabled = compute.describe_vpc_attribute(
     DryRun=False,
+    VpcId=vpc_id,
     Attribute='enableDnsSupport'
 )
     return dns_support_enabled['EnableDnsSupport']['Value']